@@ -0,0 +1,192 @@
+"""Compare the indexed matcher with the pairwise SequenceMatcher scan.
+
+Builds a synthetic library, derives noisy playlist tracks from it (case,
+accents, "(Remastered)" style suffixes, featured artists, other albums)
+plus tracks that are not in the library, and reports the time and accuracy
+of both approaches. A second set adds other versions of library songs,
+e.g. "Hello - Live at the BBC" next to "Hello", and asks for each version
+by its exact title without an album.
+
+    python benchmarks/bench_matching.py --library-size 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from difflib import SequenceMatcher
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "plex-playlist-sync")
+)
+
+from utils.helperClasses import Track  # noqa: E402
+from utils.matching import LibraryIndex  # noqa: E402
+
+SYLLABLES = [
+    "ka", "lo", "mi", "ra", "ne", "to", "su", "vi", "da", "el", "on", "ar",
+    "is", "um", "be", "ch", "or", "an", "yo", "li", "ze", "qu", "ho", "ma",
+]
+SUFFIXES = [
+    " (Remastered)", " - Radio Edit", " (feat. {})", " - Live", " [Mono]",
+    " (2011 Remaster)",
+]
+VERSIONS = [
+    " - Live at the BBC", " (Remastered 2009)", " - Radio Edit",
+    " (Acoustic)", " - Extended Mix",
+]
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+
+
+def _phrase(rng: random.Random, words: list, low: int, high: int) -> str:
+    # a skewed pick makes a few words very common, like "love" in titles
+    count = rng.randint(low, high)
+    return " ".join(
+        words[int(len(words) * rng.random() ** 3)] for _ in range(count)
+    ).title()
+
+
+def build_library(size: int, seed: int = 7) -> list:
+    """Return (key, title, artist, album) rows of a synthetic library."""
+    rng = random.Random(seed)
+    words = list({_word(rng) for _ in range(20000)})
+    artists = [_phrase(rng, words, 1, 3) for _ in range(max(size // 12, 1))]
+    rows = []
+    for key in range(size):
+        artist = rng.choice(artists)
+        album = _phrase(rng, words, 1, 3)
+        rows.append((str(key), _phrase(rng, words, 1, 5), artist, album))
+    return rows
+
+
+def build_queries(rows: list, count: int, seed: int = 11) -> list:
+    """Return (Track, expected key or None) pairs with realistic noise."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        if rng.random() < 0.1:
+            title = _phrase(rng, [_word(rng) for _ in range(50)], 2, 4)
+            queries.append((Track(title, "Unknown Artist", "", ""), None))
+            continue
+        key, title, artist, album = rng.choice(rows)
+        if rng.random() < 0.4:
+            title += rng.choice(SUFFIXES).format(rng.choice(rows)[2])
+        if rng.random() < 0.3:
+            title = title.upper() if rng.random() < 0.5 else title.lower()
+        if rng.random() < 0.3:
+            album = ""
+        if rng.random() < 0.1:
+            artist = artist.replace("a", "á", 1)
+        queries.append((Track(title, artist, album, ""), key))
+    return queries
+
+
+def build_versions(rows: list, count: int, seed: int = 5) -> tuple:
+    """Return version rows of library songs and queries naming each version.
+
+    Half of the versions are indexed before their song and half after it,
+    so the first indexed one never wins by order alone.
+
+    Returns:
+        tuple: rows to index before the library, rows to index after it
+            and (Track, expected key) pairs
+    """
+    rng = random.Random(seed)
+    before, after, queries = [], [], []
+    for n, (key, title, artist, album) in enumerate(
+        rng.sample(rows, min(count, len(rows)))
+    ):
+        version = (f"v{n}", title + rng.choice(VERSIONS), artist, album)
+        (before if n % 2 else after).append(version)
+        queries.append((Track(title, artist, "", ""), key))
+        queries.append((Track(version[1], artist, "", ""), version[0]))
+    return before, after, queries
+
+
+def legacy_match(rows: list, track: Track):
+    """The matching loop used before the index, run against every row."""
+    for key, title, artist, album in rows:
+        if SequenceMatcher(None, title.lower(), track.title.lower()).quick_ratio() <= 0.9:
+            continue
+        if SequenceMatcher(None, artist.lower(), track.artist.lower()).quick_ratio() >= 0.9:
+            return key
+        if SequenceMatcher(None, album.lower(), track.album.lower()).quick_ratio() >= 0.9:
+            return key
+    return None
+
+
+def score(rows: list, results: list, queries: list) -> dict:
+    by_key = {row[0]: row[1:] for row in rows}
+    correct = wrong = missed = 0
+    for found, (_, expected) in zip(results, queries):
+        if found is None:
+            missed += expected is not None
+            correct += expected is None
+        # the library can hold identical copies, any of them is correct
+        elif expected is not None and by_key[found] == by_key[expected]:
+            correct += 1
+        else:
+            wrong += 1
+    return {"correct": correct, "wrong": wrong, "missed": missed}
+
+
+def report(name: str, elapsed: float, queries: list, counts: dict) -> None:
+    total = len(queries)
+    print(
+        f"{name:<10} {total:>7} queries  {elapsed / total * 1000:9.3f} ms/query"
+        f"  accuracy {counts['correct'] / total:6.1%}"
+        f"  wrong {counts['wrong']:>5}  missed {counts['missed']:>5}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--library-size", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument(
+        "--legacy-queries",
+        type=int,
+        default=50,
+        help="the pairwise scan is slow, it only runs on a sample",
+    )
+    args = parser.parse_args()
+
+    rows = build_library(args.library_size)
+    queries = build_queries(rows, args.queries)
+
+    start = time.perf_counter()
+    index = LibraryIndex()
+    for key, title, artist, album in rows:
+        index.add(key, title, [artist], album)
+    print(
+        f"indexed {len(rows)} tracks in {time.perf_counter() - start:.2f}s"
+    )
+
+    start = time.perf_counter()
+    results = [index.match(track) for track, _ in queries]
+    report("index", time.perf_counter() - start, queries, score(rows, results, queries))
+
+    before, after, version_queries = build_versions(rows, args.queries // 2)
+    index = LibraryIndex()
+    for key, title, artist, album in before + rows + after:
+        index.add(key, title, [artist], album)
+    start = time.perf_counter()
+    results = [index.match(track) for track, _ in version_queries]
+    report(
+        "versions",
+        time.perf_counter() - start,
+        version_queries,
+        score(before + rows + after, results, version_queries),
+    )
+
+    sample = queries[: args.legacy_queries]
+    start = time.perf_counter()
+    results = [legacy_match(rows, track) for track, _ in sample]
+    report("pairwise", time.perf_counter() - start, sample, score(rows, results, sample))
+
+
+if __name__ == "__main__":
+    main()
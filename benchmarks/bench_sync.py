@@ -0,0 +1,626 @@
+"""Run full spotify sync cycles against local stand-ins of the services.
+
+A child process serves fake Spotify, Plex and Jellyfin APIs over HTTP with
+a synthetic library (see bench_matching.py) and playlists whose tracks
+overlap between playlists and carry the usual title noise. Another child
+runs ``spotify_playlist_sync`` against them, first with an empty sync
+database then again after a share of the playlists was edited, and
+reports wall time, requests per service, peak RSS and how many playlist
+entries point to the right library track.
+
+    python benchmarks/bench_sync.py --library-size 10000 100000 500000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from queue import Empty
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import quoteattr
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "plex-playlist-sync")
+)
+
+from bench_matching import build_library, build_queries  # noqa: E402
+
+SUFFIX = " - Spotify"
+
+
+def _isrc(key: str) -> str:
+    return f"QZBNC{int(key):07d}"
+
+
+def _duration(key: str) -> int:
+    """Length of a library track in milliseconds."""
+    return 120000 + int(key) * 7919 % 240000
+
+
+def build_playlists(
+    rows: list, count: int, length: int, seed: int = 13
+) -> list:
+    """Return playlists as lists of (source id, Track, expected key or None).
+
+    Playlists draw from a shared pool of source tracks, skewed towards the
+    popular ones, so the same track shows up in several playlists but only
+    once per playlist.
+    """
+    rng = random.Random(seed)
+    pool = [
+        (f"t{n}", track, key)
+        for n, (track, key) in enumerate(
+            build_queries(rows, max(count * length * 2, 1), seed)
+        )
+    ]
+    playlists = []
+    for _ in range(count):
+        picks = {}
+        while len(picks) < min(length, len(pool)):
+            n = int(len(pool) * rng.random() ** 2)
+            picks.setdefault(n, pool[n])
+        playlists.append(list(picks.values()))
+    return playlists
+
+
+class FakeServices:
+    """State of the fake Spotify, Plex and Jellyfin servers."""
+
+    def __init__(self, rows: list, playlists: list) -> None:
+        self.rows = rows
+        self.by_key = {row[0]: row for row in rows}
+        self.playlists = playlists
+        self.snapshots = [0] * len(playlists)
+        self.rng = random.Random(17)
+        self.requests = Counter()
+        self.lock = threading.RLock()
+        self.plex_tracks = [
+            "<Track type=\"track\" ratingKey=\"%s\" key=\"/library/metadata/%s\""
+            " title=%s grandparentTitle=%s parentTitle=%s duration=\"%s\"/>"
+            % (
+                key,
+                key,
+                quoteattr(title),
+                quoteattr(artist),
+                quoteattr(album),
+                _duration(key),
+            )
+            for key, title, artist, album in rows
+        ]
+        self.jellyfin_search = {}
+        for row in rows:
+            self.jellyfin_search.setdefault(row[1].lower(), []).append(row)
+        # playlist id -> {"title", "summary", "entries": [(entry, key)]}
+        self.plex_playlists = {}
+        self.jellyfin_playlists = {}
+        self.next_id = 1
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def edit_playlists(self, fraction: float) -> None:
+        """Swap a track and move another in a fraction of the playlists."""
+        pool = [track for tracks in self.playlists for track in tracks]
+        for n in self.rng.sample(
+            range(len(self.playlists)), round(len(self.playlists) * fraction)
+        ):
+            tracks = self.playlists[n]
+            if len(tracks) < 2:
+                continue
+            new = self.rng.choice(pool)
+            if new not in tracks:
+                tracks[self.rng.randrange(len(tracks))] = new
+            tracks.insert(0, tracks.pop())
+            self.snapshots[n] += 1
+
+    def report(self) -> dict:
+        """Return request counts and match accuracy of both targets."""
+        with self.lock:
+            requests = dict(self.requests)
+            self.requests.clear()
+        return {
+            "requests": requests,
+            "plex": self._accuracy(self.plex_playlists, str),
+            "jellyfin": self._accuracy(
+                self.jellyfin_playlists, lambda item: item[1:]
+            ),
+        }
+
+    def _accuracy(self, target_playlists: dict, to_key) -> dict:
+        by_title = {p["title"]: p for p in target_playlists.values()}
+        correct = wrong = expected_total = 0
+        for n, tracks in enumerate(self.playlists):
+            # the library can hold identical copies, any of them is correct
+            expected = Counter(
+                self.by_key[key][1:] for _, _, key in tracks if key is not None
+            )
+            playlist = by_title.get(f"Playlist {n}{SUFFIX}", {"entries": []})
+            actual = Counter(
+                self.by_key[to_key(item)][1:] for _, item in playlist["entries"]
+            )
+            found = sum((expected & actual).values())
+            correct += found
+            wrong += sum(actual.values()) - found
+            expected_total += sum(expected.values())
+        return {"correct": correct, "wrong": wrong, "expected": expected_total}
+
+
+def _page(params: dict, default_limit: int):
+    offset = int(params.get("offset", params.get("startIndex", 0)))
+    limit = int(params.get("limit", default_limit))
+    return offset, limit
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    services: FakeServices = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _reply(self, body: str = "", content_type: str = "application/json"):
+        data = body.encode()
+        self.send_response(200 if data else 204)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self) -> None:
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        service, _, path = url.path.lstrip("/").partition("/")
+        if service == "bench":
+            with self.services.lock:
+                if "edit" in params:
+                    self.services.edit_playlists(float(params["edit"]))
+                    return self._reply()
+                return self._reply(json.dumps(self.services.report()))
+        with self.services.lock:
+            self.services.requests[service] += 1
+        handler = getattr(self, f"_{service}", None)
+        if handler is None:
+            return self.send_error(404)
+        with self.services.lock:
+            body = handler(self.command, "/" + path, params)
+        if body is None:
+            return self.send_error(404)
+        content_type = "text/xml" if service == "plex" else "application/json"
+        self._reply(body, content_type)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def _spotify(self, method: str, path: str, params: dict):
+        playlists = self.services.playlists
+        if re.fullmatch(r"/v1/users/[^/]+/playlists", path):
+            offset, limit = _page(params, 50)
+            base = f"http://{self.headers['Host']}/spotify"
+            items = [
+                {
+                    "uri": f"spotify:playlist:p{n}",
+                    "name": f"Playlist {n}",
+                    "description": f"Benchmark playlist {n}",
+                    "images": [{"url": f"{base}/images/p{n}.jpg"}],
+                    "snapshot_id": f"s{n}.{self.services.snapshots[n]}",
+                }
+                for n in range(offset, min(offset + limit, len(playlists)))
+            ]
+            return json.dumps({"items": items, "total": len(playlists)})
+        match = re.fullmatch(r"/images/p(\d+).jpg", path)
+        if match:
+            return f"image of playlist {match.group(1)}"
+        match = re.fullmatch(r"/v1/playlists/p(\d+)/(?:tracks|items)", path)
+        if match:
+            tracks = playlists[int(match.group(1))]
+            offset, limit = _page(params, 100)
+            items = [
+                {
+                    "track": {
+                        "id": source_id,
+                        "name": track.title,
+                        "duration_ms": self._spotify_duration(source_id, key),
+                        "artists": [{"name": track.artist}],
+                        "album": {"name": track.album},
+                        # half of the tracks come with an ISRC
+                        "external_ids": {"isrc": _isrc(key)}
+                        if key is not None and int(source_id[1:]) % 2
+                        else {},
+                    }
+                }
+                for source_id, track, key in tracks[offset : offset + limit]
+            ]
+            return json.dumps({"items": items, "total": len(tracks)})
+        return None
+
+    @staticmethod
+    def _spotify_duration(source_id: str, key) -> int:
+        """Length of the library track give or take two seconds."""
+        if key is None:
+            return 200000
+        return _duration(key) + int(source_id[1:]) % 4000 - 2000
+
+    def _plex_playlist_xml(self, playlist_id: int, playlist: dict) -> str:
+        return (
+            f'<Playlist type="playlist" ratingKey="{playlist_id}"'
+            f' key="/playlists/{playlist_id}/items" playlistType="audio"'
+            f' smart="0" title={quoteattr(playlist["title"])}'
+            f' leafCount="{len(playlist["entries"])}"/>'
+        )
+
+    def _plex(self, method: str, path: str, params: dict):
+        services = self.services
+        container = "<MediaContainer{}>{}</MediaContainer>"
+        if path == "/":
+            return container.format(' machineIdentifier="bench"', "")
+        if path == "/library":
+            return container.format("", "")
+        if path == "/library/sections":
+            return container.format(
+                "",
+                '<Directory key="1" type="artist" title="Music"'
+                ' updatedAt="1700000000"/>',
+            )
+        if path == "/library/sections/1/all":
+            start = int(params.get("X-Plex-Container-Start", 0))
+            size = int(params.get("X-Plex-Container-Size", 50))
+            tracks = services.plex_tracks
+            return container.format(
+                f' totalSize="{len(tracks)}" librarySectionID="1"',
+                "".join(tracks[start : start + size]),
+            )
+        if re.fullmatch(r"/library/metadata/\d+/posters", path):
+            return ""
+        if re.fullmatch(r"/library/metadata/[\d,]+", path):
+            keys = [int(key) for key in path.rsplit("/", 1)[1].split(",")]
+            return container.format(
+                f' size="{len(keys)}"',
+                "".join(
+                    services.plex_tracks[key]
+                    for key in keys
+                    if key < len(services.plex_tracks)
+                ),
+            )
+        if path == "/playlists" and method == "GET":
+            title = params.get("title")
+            return container.format(
+                "",
+                "".join(
+                    self._plex_playlist_xml(pid, p)
+                    for pid, p in services.plex_playlists.items()
+                    if title is None or p["title"] == title
+                ),
+            )
+        if path == "/playlists" and method == "POST":
+            playlist_id = services.new_id()
+            playlist = {
+                "title": params["title"],
+                "summary": "",
+                "entries": [],
+            }
+            self._plex_add(playlist, params["uri"])
+            services.plex_playlists[playlist_id] = playlist
+            return container.format(
+                "", self._plex_playlist_xml(playlist_id, playlist)
+            )
+        match = re.fullmatch(r"/playlists/(\d+)(/items)?(?:/(\d+))?(/move)?", path)
+        if not match or int(match.group(1)) not in services.plex_playlists:
+            return None
+        playlist = services.plex_playlists[int(match.group(1))]
+        items, entry, move = match.group(2), match.group(3), match.group(4)
+        entries = playlist["entries"]
+        if not items:
+            playlist["summary"] = params.get("summary", playlist["summary"])
+            return ""
+        if method == "GET":
+            return container.format(
+                "",
+                "".join(
+                    services.plex_tracks[int(key)].replace(
+                        "<Track ", f'<Track playlistItemID="{entry}" ', 1
+                    )
+                    for entry, key in entries
+                ),
+            )
+        if method == "PUT" and not entry:
+            self._plex_add(playlist, params["uri"])
+            return ""
+        position = next(i for i, (e, _) in enumerate(entries) if str(e) == entry)
+        moved = entries.pop(position)
+        if method == "PUT" and move:
+            after = params.get("after")
+            index = 0
+            if after is not None:
+                index = 1 + next(
+                    i for i, (e, _) in enumerate(entries) if str(e) == after
+                )
+            entries.insert(index, moved)
+        return ""
+
+    def _plex_add(self, playlist: dict, uri: str) -> None:
+        keys = unquote(uri).rsplit("/", 1)[-1].split(",")
+        playlist["entries"] += [(self.services.new_id(), key) for key in keys]
+
+    def _jellyfin_item(self, row) -> dict:
+        key, title, artist, album = row
+        return {
+            "Id": f"j{key}",
+            "Name": title,
+            "AlbumArtist": artist,
+            "Artists": [artist],
+            "Album": album,
+            "Type": "Audio",
+            "RunTimeTicks": _duration(key) * 10000,
+            "ProviderIds": {"ISRC": _isrc(key)},
+        }
+
+    def _jellyfin(self, method: str, path: str, params: dict):
+        services = self.services
+        if path == "/Users":
+            return json.dumps([{"Id": "u1", "Name": "bench"}])
+        if path == "/Items":
+            offset, limit = _page(params, 100)
+            if params.get("includeItemTypes") == "Playlist":
+                items = [
+                    {"Id": pid, "Name": p["title"], "Type": "Playlist"}
+                    for pid, p in services.jellyfin_playlists.items()
+                ]
+                return json.dumps({"Items": items, "TotalRecordCount": len(items)})
+            rows = services.rows
+            if "ids" in params:
+                rows = [
+                    services.by_key[item_id[1:]]
+                    for item_id in params["ids"].split(",")
+                    if item_id[1:] in services.by_key
+                ]
+            elif "minDateLastSaved" in params:
+                rows = []
+            elif params.get("sortBy") == "DateCreated":
+                rows = rows[::-1]
+            return json.dumps(
+                {
+                    "Items": [
+                        self._jellyfin_item(r)
+                        for r in rows[offset : offset + limit]
+                    ],
+                    "TotalRecordCount": len(rows),
+                }
+            )
+        if path == "/Search/Hints":
+            rows = services.jellyfin_search.get(
+                params.get("searchTerm", "").lower(), []
+            )
+            hints = [self._jellyfin_item(r) for r in rows]
+            return json.dumps(
+                {"SearchHints": hints, "TotalRecordCount": len(hints)}
+            )
+        if path == "/Playlists" and method == "POST":
+            playlist_id = f"pl{services.new_id()}"
+            services.jellyfin_playlists[playlist_id] = {
+                "title": params["name"],
+                "entries": [],
+            }
+            return json.dumps({"Id": playlist_id})
+        match = re.fullmatch(r"/Playlists/([^/]+)/Items(?:/([^/]+)/Move/(\d+))?", path)
+        if not match or match.group(1) not in services.jellyfin_playlists:
+            return None
+        entries = services.jellyfin_playlists[match.group(1)]["entries"]
+        if match.group(2):
+            position = next(
+                i for i, (e, _) in enumerate(entries) if e == match.group(2)
+            )
+            entries.insert(int(match.group(3)), entries.pop(position))
+            return ""
+        if method == "GET":
+            offset, limit = _page(params, 100)
+            items = [
+                {"Id": item, "PlaylistItemId": entry}
+                for entry, item in entries[offset : offset + limit]
+            ]
+            return json.dumps({"Items": items, "TotalRecordCount": len(entries)})
+        if method == "POST":
+            entries += [
+                (f"e{services.new_id()}", item)
+                for item in params["ids"].split(",")
+            ]
+            return ""
+        if method == "DELETE":
+            stale = set(params["entryIds"].split(","))
+            entries[:] = [e for e in entries if e[0] not in stale]
+            return ""
+        return None
+
+
+def serve(args: argparse.Namespace, library_size: int, ready) -> None:
+    """Serve the fake services until the process is terminated."""
+    rows = build_library(library_size)
+    Handler.services = FakeServices(
+        rows, build_playlists(rows, args.playlists, args.playlist_length)
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def user_inputs(base: str, data_dir: str, args: argparse.Namespace):
+    from utils.helperClasses import UserInputs
+
+    return UserInputs(
+        plex_urls=[f"{base}/plex"],
+        plex_tokens=["bench"],
+        plex_index_page_size=1000,
+        write_missing_as_csv=False,
+        append_service_suffix=True,
+        add_playlist_poster=True,
+        add_playlist_description=True,
+        append_instead_of_sync=False,
+        wait_seconds=0,
+        spotify_wait_seconds=0,
+        ytmusic_wait_seconds=0,
+        deezer_wait_seconds=0,
+        schedule_jitter=0,
+        playlist_intervals={},
+        library_poll_seconds=0,
+        metrics_port=0,
+        data_dir=data_dir,
+        match_cache=True,
+        match_cache_negative_ttl=86400,
+        skip_unchanged_playlists=True,
+        match_concurrency=8,
+        target_concurrency=2,
+        fetch_concurrency=4,
+        http_pool_size=10,
+        http_retries=0,
+        http_backoff_factor=0,
+        spotipy_client_id="bench",
+        spotipy_client_secret="bench",
+        spotify_user_id="bench",
+        deezer_user_id="",
+        deezer_playlist_ids="",
+        jellyfin_urls=[f"{base}/jellyfin"],
+        jellyfin_tokens=["bench"],
+        jellyfin_users=["bench"],
+        jellyfin_library_snapshot=not args.jellyfin_search,
+        jellyfin_snapshot_page_size=1000,
+        jellyfin_playlist_batch_size=100,
+        yt_music_auth_file="",
+        ytmusic_concurrency=4,
+        ytmusic_requests_per_second=0,
+    )
+
+
+def run_cycles(args: argparse.Namespace, port: int, results) -> None:
+    """Sync every playlist ``args.cycles`` times and report each cycle."""
+    import logging
+    import urllib.request
+
+    import spotipy
+    from jellyfinapi.jellyfinapi_client import JellyfinapiClient
+    from plexapi.server import PlexServer
+
+    from utils.jellyfin import JellyfinTarget
+    from utils.plex import PlexTarget
+    from utils.spotify import spotify_playlist_sync
+    from utils.store import open_store
+    from utils.transport import HttpClientInstance, new_session
+
+    logging.getLogger("jellyfinapi").setLevel(logging.WARNING)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as data_dir:
+        userInputs = user_inputs(base, data_dir, args)
+        store = open_store(data_dir)
+        sp = spotipy.Spotify(auth="bench", requests_session=new_session())
+        sp.prefix = f"{base}/spotify/v1/"
+        plex_url, jellyfin_url = f"{base}/plex", f"{base}/jellyfin"
+        plex = PlexServer(plex_url, "bench", session=new_session())
+        jellyfin = JellyfinapiClient(
+            http_client_instance=HttpClientInstance(new_session()),
+            x_emby_token="bench",
+            server_url=jellyfin_url,
+        )
+        urllib.request.urlopen(f"{base}/bench").read()
+        for cycle in range(args.cycles):
+            start = time.perf_counter()
+            targets = [
+                PlexTarget(plex, userInputs, store),
+                JellyfinTarget(
+                    jellyfin, jellyfin_url, "bench", userInputs, store
+                ),
+            ]
+            spotify_playlist_sync(sp, targets, userInputs)
+            for target in targets:
+                target.close()
+            elapsed = time.perf_counter() - start
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report = json.loads(
+                urllib.request.urlopen(f"{base}/bench").read()
+            )
+            results.put((cycle, elapsed, peak_rss, report))
+            urllib.request.urlopen(f"{base}/bench?edit={args.edit}").read()
+    results.put(None)
+
+
+def print_cycle(cycle: int, elapsed: float, peak_rss: int, report: dict):
+    requests = report["requests"]
+    print(
+        f"  cycle {cycle + 1}  {elapsed:8.2f}s  peak RSS {peak_rss / 1024:7.1f} MiB"
+        f"  requests {sum(requests.values()):>6} ("
+        + ", ".join(f"{k} {v}" for k, v in sorted(requests.items()))
+        + ")"
+    )
+    for target in ("plex", "jellyfin"):
+        counts = report[target]
+        expected = counts["expected"] or 1
+        print(
+            f"    {target:<9} found {counts['correct'] / expected:6.1%}"
+            f" of {counts['expected']} entries, wrong {counts['wrong']}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--library-size", type=int, nargs="+", default=[10000]
+    )
+    parser.add_argument("--playlists", type=int, default=50)
+    parser.add_argument("--playlist-length", type=int, default=100)
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument(
+        "--edit",
+        type=float,
+        default=0.1,
+        help="share of the playlists edited on spotify between cycles",
+    )
+    parser.add_argument(
+        "--jellyfin-search",
+        action="store_true",
+        help="match with one jellyfin search per track instead of a snapshot",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # fresh processes keep the peak RSS of one size from hiding the next
+    context = multiprocessing.get_context("spawn")
+    for library_size in args.library_size:
+        print(
+            f"library {library_size} tracks, {args.playlists} playlists of"
+            f" {args.playlist_length} tracks"
+        )
+        ready, results = context.Queue(), context.Queue()
+        server = context.Process(
+            target=serve, args=(args, library_size, ready), daemon=True
+        )
+        server.start()
+        port = ready.get()
+        client = context.Process(target=run_cycles, args=(args, port, results))
+        client.start()
+        try:
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                except Empty:
+                    if not client.is_alive():
+                        break
+                    continue
+                if result is None:
+                    break
+                print_cycle(*result)
+        finally:
+            client.join()
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
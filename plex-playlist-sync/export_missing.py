@@ -0,0 +1,22 @@
+"""Write the missing tracks of every synced playlist as csv files.
+
+    python ./plex-playlist-sync/export_missing.py [directory]
+
+Files are written to ``<directory>/<target>/<playlist>.csv``, by default
+under ``$DATA_DIR/missing``.
+"""
+import logging
+import os
+import sys
+
+from utils.missing import export_missing_tracks
+from utils.store import open_store
+
+data_dir = os.getenv("DATA_DIR", "/data")
+path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(data_dir, "missing")
+
+store = open_store(data_dir)
+if store is None:
+    sys.exit(1)
+count = export_missing_tracks(store, path)
+logging.info("Wrote %s missing track files to %s", count, path)
@@ -1,170 +1,415 @@
+import importlib.util
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Optional
 
-import deezer
 import spotipy
 from jellyfinapi.jellyfinapi_client import JellyfinapiClient
+from plexapi.exceptions import Unauthorized
 from plexapi.server import PlexServer
 from spotipy.oauth2 import SpotifyClientCredentials
 from ytmusicapi import YTMusic
 
-from utils.deezer import deezer_playlist_sync
+from utils.deezer import deezer_playlist_sync, new_deezer_client
 from utils.helperClasses import UserInputs
+from utils.jellyfin import JellyfinTarget, jellyfin_library_generation
+from utils.metrics import (
+    SOURCE_SECONDS,
+    record_target_cycle,
+    start_metrics_server,
+)
+from utils.plex import PlexTarget, plex_library_generation
+from utils.scheduler import LibraryWatcher, Scheduler, plex_scan_finished
 from utils.spotify import spotify_playlist_sync
+from utils.store import open_store
+from utils.sync import recheck_missing_tracks
+from utils.transport import HttpClientInstance, new_session
 from utils.ytmusic import ytmusic_playlist_sync
 
+
+
+def parse_intervals(value: str) -> Dict[str, int]:
+    """Parse "<playlist name or id>=<seconds>" entries separated by ";"."""
+    intervals = {}
+    for entry in value.split(";"):
+        name, _, seconds = entry.rpartition("=")
+        if name.strip() and seconds.strip().isdigit():
+            intervals[name.strip()] = int(seconds)
+    return intervals
+
+
+def parse_list(value: Optional[str]) -> List[str]:
+    """Split a comma separated setting, e.g. the urls of several servers."""
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
 # Read ENV variables
+wait_seconds = int(os.getenv("SECONDS_TO_WAIT", 86400))
 userInputs = UserInputs(
-    plex_url=os.getenv("PLEX_URL"),
-    plex_token=os.getenv("PLEX_TOKEN"),
+    plex_urls=parse_list(os.getenv("PLEX_URL")),
+    plex_tokens=parse_list(os.getenv("PLEX_TOKEN")),
+    plex_index_page_size=int(os.getenv("PLEX_INDEX_PAGE_SIZE", 1000)),
     write_missing_as_csv=os.getenv("WRITE_MISSING_AS_CSV", "0") == "1",
     append_service_suffix=os.getenv("APPEND_SERVICE_SUFFIX", "0") == "1",
     add_playlist_poster=os.getenv("ADD_PLAYLIST_POSTER", "1") == "1",
     add_playlist_description=os.getenv("ADD_PLAYLIST_DESCRIPTION", "1") == "1",
     append_instead_of_sync=os.getenv("APPEND_INSTEAD_OF_SYNC", False) == "1",
-    wait_seconds=int(os.getenv("SECONDS_TO_WAIT", 86400)),
+    wait_seconds=wait_seconds,
+    spotify_wait_seconds=int(
+        os.getenv("SPOTIFY_SECONDS_TO_WAIT", wait_seconds)
+    ),
+    ytmusic_wait_seconds=int(
+        os.getenv("YTMUSIC_SECONDS_TO_WAIT", wait_seconds)
+    ),
+    deezer_wait_seconds=int(os.getenv("DEEZER_SECONDS_TO_WAIT", wait_seconds)),
+    schedule_jitter=float(os.getenv("SCHEDULE_JITTER", 0.1)),
+    playlist_intervals=parse_intervals(os.getenv("PLAYLIST_INTERVALS", "")),
+    library_poll_seconds=int(os.getenv("LIBRARY_POLL_SECONDS", 300)),
+    metrics_port=int(os.getenv("METRICS_PORT", 0)),
+    data_dir=os.getenv("DATA_DIR", "/data"),
+    match_cache=os.getenv("MATCH_CACHE", "1") == "1",
+    match_cache_negative_ttl=int(
+        os.getenv("MATCH_CACHE_NEGATIVE_TTL", 86400)
+    ),
+    skip_unchanged_playlists=os.getenv("SKIP_UNCHANGED_PLAYLISTS", "1") == "1",
+    match_concurrency=int(os.getenv("MATCH_CONCURRENCY", 4)),
+    target_concurrency=int(os.getenv("TARGET_CONCURRENCY", 2)),
+    fetch_concurrency=int(os.getenv("FETCH_CONCURRENCY", 4)),
+    http_pool_size=int(os.getenv("HTTP_POOL_SIZE", 10)),
+    http_retries=int(os.getenv("HTTP_RETRIES", 3)),
+    http_backoff_factor=float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5)),
     spotipy_client_id=os.getenv("SPOTIFY_CLIENT_ID"),
     spotipy_client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
     spotify_user_id=os.getenv("SPOTIFY_USER_ID"),
     deezer_user_id=os.getenv("DEEZER_USER_ID"),
     deezer_playlist_ids=os.getenv("DEEZER_PLAYLIST_ID"),
-    jellyfin_url=os.getenv("JELLYFIN_URL"),
-    jellyfin_token=os.getenv("JELLYFIN_TOKEN"),
-    jellyfin_user=os.getenv("JELLYFIN_USER"),
+    jellyfin_urls=parse_list(os.getenv("JELLYFIN_URL")),
+    jellyfin_tokens=parse_list(os.getenv("JELLYFIN_TOKEN")),
+    jellyfin_users=parse_list(os.getenv("JELLYFIN_USER")),
+    jellyfin_library_snapshot=os.getenv("JELLYFIN_LIBRARY_SNAPSHOT", "1") == "1",
+    jellyfin_snapshot_page_size=int(
+        os.getenv("JELLYFIN_SNAPSHOT_PAGE_SIZE", 1000)
+    ),
+    jellyfin_playlist_batch_size=int(
+        os.getenv("JELLYFIN_PLAYLIST_BATCH_SIZE", 100)
+    ),
     yt_music_auth_file=os.getenv("YTMUSIC_AUTH_FILE"),
+    ytmusic_concurrency=int(os.getenv("YTMUSIC_CONCURRENCY", 4)),
+    ytmusic_requests_per_second=float(
+        os.getenv("YTMUSIC_REQUESTS_PER_SECOND", 5)
+    ),
 )
-while True:
-    logging.info("Starting playlist sync")
+store = open_store(userInputs.data_dir)
+if userInputs.metrics_port:
+    start_metrics_server(userInputs.metrics_port)
 
-
-    ########## PLEX AUTH ##########
-    logging.info("Starting plex auth")
-    PL_AUTHSUCCESS = False
-    if userInputs.plex_url and userInputs.plex_token:
-        try:
-            plex = PlexServer(userInputs.plex_url, userInputs.plex_token)
-            PL_AUTHSUCCESS = True
-        except:
-            logging.error("Plex Authorization error")
-    else:
-        logging.error("Missing Plex Authorization Variables")
-
-    ########## JELLYFIN AUTH ##########
-    logging.info("Starting jellyfin auth")
-
-    JL_AUTHSUCCESS = False
-    if userInputs.jellyfin_url and userInputs.jellyfin_token:
-        try:
-            jellyfin = JellyfinapiClient(x_emby_token=userInputs.jellyfin_token, server_url=userInputs.jellyfin_url)
-            JL_AUTHSUCCESS = True
-        except:
-            logging.error("jellyfin Authorization error")
-    else:
-        logging.error("Missing jellyfin Authorization Variables")
+# Clients are built once and reused by every cycle, keeping their pooled
+# connections and access tokens alive
+clients = {}
 
 
+def session(requests_per_second: float = 0):
+    return new_session(
+        userInputs.http_pool_size,
+        userInputs.http_retries,
+        userInputs.http_backoff_factor,
+        requests_per_second,
+    )
 
-    ########## SPOTIFY SYNC ##########
 
+def sync_spotify(targets, playlist_ids=None) -> None:
     logging.info("Starting spotify playlist sync")
-
-    SP_AUTHSUCCESS = False
-
-    if (
+    if not (
         userInputs.spotipy_client_id
         and userInputs.spotipy_client_secret
         and userInputs.spotify_user_id
     ):
+        logging.info(
+            "Missing one or more Spotify Authorization Variables, skipping"
+            " spotify sync"
+        )
+        return
+    if "spotify" not in clients:
         try:
-            sp = spotipy.Spotify(
+            spotify_session = session()
+            # the credentials manager requests a new token once it expires
+            clients["spotify"] = spotipy.Spotify(
                 auth_manager=SpotifyClientCredentials(
                     userInputs.spotipy_client_id,
                     userInputs.spotipy_client_secret,
-                )
+                    requests_session=spotify_session,
+                ),
+                requests_session=spotify_session,
             )
-            SP_AUTHSUCCESS = True
         except:
             logging.info("Spotify Authorization error, skipping spotify sync")
+            return
+    spotify_playlist_sync(
+        clients["spotify"], targets, userInputs, playlist_ids
+    )
+    logging.info("Spotify playlist sync complete")
 
-    else:
+
+def sync_ytmusic(targets, playlist_ids=None) -> None:
+    logging.info("Starting youtube music playlist sync")
+    if not (
+        userInputs.yt_music_auth_file
+        and os.path.exists(userInputs.yt_music_auth_file)
+    ):
         logging.info(
-            "Missing one or more Spotify Authorization Variables, skipping"
-            " spotify sync"
+            "Missing one or more youtube Authorization Variables, skipping"
+            " youtube sync"
         )
+        return
+    if "ytmusic" not in clients:
+        try:
+            clients["ytmusic"] = YTMusic(
+                userInputs.yt_music_auth_file,
+                # shared by the concurrent playlist downloads
+                requests_session=session(
+                    userInputs.ytmusic_requests_per_second
+                ),
+            )
+        except:
+            logging.info("youtube Authorization error, skipping ytmusic sync")
+            return
+    ytmusic_playlist_sync(
+        clients["ytmusic"], targets, userInputs, playlist_ids
+    )
+    logging.info("ytmusic playlist sync complete")
 
-    if SP_AUTHSUCCESS:
-        if PL_AUTHSUCCESS and JL_AUTHSUCCESS:
-            spotify_playlist_sync(sp, plex, jellyfin, userInputs)
-        elif PL_AUTHSUCCESS and JL_AUTHSUCCESS is False:
-            spotify_playlist_sync(sp, plex, None, userInputs)
-        elif JL_AUTHSUCCESS and PL_AUTHSUCCESS is False:
-            spotify_playlist_sync(sp, None, jellyfin, userInputs)
-        else:
-            logging.error("Plex or jellyfin auth must be present")
-            break
 
-    logging.info("Spotify playlist sync complete")
+def sync_deezer(targets, playlist_ids=None) -> None:
+    logging.info("Starting Deezer playlist sync")
+    if not userInputs.deezer_user_id:
+        logging.info(
+            "Missing one or more deezer Authorization Variables, skipping"
+            " deezer sync"
+        )
+        return
+    if "deezer" not in clients:
+        try:
+            clients["deezer"] = new_deezer_client(session())
+        except:
+            logging.info("deezer Authorization error, skipping deezer sync")
+            return
+    deezer_playlist_sync(clients["deezer"], targets, userInputs, playlist_ids)
+    logging.info("Deezer playlist sync complete")
 
 
+def timed(name: str, sync, *args) -> float:
+    """Run one source pipeline, logging instead of raising its errors."""
+    start = time.monotonic()
+    try:
+        sync(*args)
+    except Exception:
+        logging.exception("%s playlist sync failed", name)
+    return time.monotonic() - start
 
-    ########## YT MUSIC SYNC ##########
 
-    logging.info("Starting youtube music playlist sync")
-    YT_AUTHSUCCESS = False
+def connect_plex(url: str, token: str):
+    """Return the plex target for this cycle, None if unavailable."""
+    logging.info("Starting plex auth for %s", url)
+    key = f"plex:{url}"
+    try:
+        if key not in clients:
+            clients[key] = PlexServer(url, token, session=session())
+            listen_to_plex(clients[key])
+        return PlexTarget(clients[key], userInputs, store)
+    except Unauthorized:
+        # connect again next cycle in case the token was replaced
+        clients.pop(key, None)
+        logging.error("Plex Authorization error for %s", url)
+    except:
+        logging.error("Plex Authorization error for %s", url)
+    return None
+
+
+def connect_jellyfin(url: str, token: str, user_name: str):
+    """Return the jellyfin target for this cycle, None if unavailable."""
+    logging.info("Starting jellyfin auth for %s", url)
+    key = f"jellyfin:{url}"
+    try:
+        if key not in clients:
+            clients[key] = JellyfinapiClient(
+                http_client_instance=HttpClientInstance(session()),
+                x_emby_token=token,
+                server_url=url,
+            )
+        return JellyfinTarget(clients[key], url, user_name, userInputs, store)
+    except:
+        logging.error("jellyfin Authorization error for %s", url)
+    return None
 
-    if (
-            os.path.exists(userInputs.yt_music_auth_file)
+
+def per_server(name: str, values: List[str], urls: List[str]) -> List[str]:
+    """Pair every server url with its setting, a single one applies to all."""
+    if len(values) == 1:
+        return values * len(urls)
+    if values and len(values) != len(urls):
+        logging.error("%s needs one entry per server or a single one", name)
+        return []
+    return values
+
+
+def configured_servers() -> Dict[str, Callable]:
+    """Return a function connecting to each configured server, by name."""
+    servers = {}
+    plex_urls = userInputs.plex_urls
+    plex_tokens = per_server("PLEX_TOKEN", userInputs.plex_tokens, plex_urls)
+    if not (plex_urls and plex_tokens):
+        logging.error("Missing Plex Authorization Variables")
+    for url, token in zip(plex_urls, plex_tokens):
+        servers[f"plex:{url}"] = partial(connect_plex, url, token)
+
+    jellyfin_urls = userInputs.jellyfin_urls
+    jellyfin_tokens = per_server(
+        "JELLYFIN_TOKEN", userInputs.jellyfin_tokens, jellyfin_urls
+    )
+    jellyfin_users = per_server(
+        "JELLYFIN_USER", userInputs.jellyfin_users, jellyfin_urls
+    )
+    if not (jellyfin_urls and jellyfin_tokens and jellyfin_users):
+        logging.error("Missing jellyfin Authorization Variables")
+    for url, token, user_name in zip(
+        jellyfin_urls, jellyfin_tokens, jellyfin_users
     ):
-        try:
-            yt = ytmusic = YTMusic(userInputs.yt_music_auth_file)
-            YT_AUTHSUCCESS = True
-        except:
-            logging.info("youtube Authorization error, skipping ytmusic sync")
+        servers[f"jellyfin:{url}"] = partial(
+            connect_jellyfin, url, token, user_name
+        )
+    return servers
 
+
+def watch(name: str, target) -> None:
+    """Watch the library of a target for changes once it was synced."""
+    if isinstance(target, PlexTarget):
+        server = target.server
+        watcher.watch(
+            name, target.generation, lambda: plex_library_generation(server)
+        )
     else:
+        client = target.client
+        watcher.watch(
+            name,
+            target.generation,
+            lambda: jellyfin_library_generation(client),
+        )
+
+
+def listen_to_plex(server: PlexServer) -> None:
+    """Check the libraries as soon as plex reports a finished scan."""
+    if not userInputs.library_poll_seconds:
+        return
+    if importlib.util.find_spec("websocket") is None:
         logging.info(
-            "Missing one or more youtube Authorization Variables, skipping"
-            " youtube sync"
+            "websocket-client is not installed, plex library changes are"
+            " noticed by polling"
         )
+        return
 
-    if YT_AUTHSUCCESS:
-        if PL_AUTHSUCCESS and JL_AUTHSUCCESS:
-            ytmusic_playlist_sync(yt, plex, jellyfin, userInputs)
-        elif PL_AUTHSUCCESS and JL_AUTHSUCCESS is False:
-            ytmusic_playlist_sync(yt, plex, None, userInputs)
-        elif JL_AUTHSUCCESS and PL_AUTHSUCCESS is False:
-            ytmusic_playlist_sync(yt, None, jellyfin, userInputs)
-        else:
-            logging.error("Plex or jellyfin auth must be present")
-            break
+    def on_alert(data: dict) -> None:
+        if plex_scan_finished(data):
+            watcher.notify()
 
-    logging.info("ytmusic playlist sync complete")
+    server.startAlertListener(on_alert)
 
-    ########## DEEZER SYNC ##########
 
-    logging.info("Starting Deezer playlist sync")
-    DZ_AUTHSUCCESS = False
+sources = {
+    "Spotify": sync_spotify,
+    "ytmusic": sync_ytmusic,
+    "Deezer": sync_deezer,
+}
+scheduler = Scheduler(
+    {
+        "Spotify": userInputs.spotify_wait_seconds,
+        "ytmusic": userInputs.ytmusic_wait_seconds,
+        "Deezer": userInputs.deezer_wait_seconds,
+    },
+    userInputs.schedule_jitter,
+)
+watcher = LibraryWatcher(userInputs.library_poll_seconds)
+servers = configured_servers()
+changed_targets = set()
 
-    if (
-        userInputs.deezer_user_id
-    ):
+while True:
+    due = scheduler.due()
+    # None syncs every playlist of the due sources
+    playlist_ids = None
+    if due:
+        # scheduled sources sync to every target
+        changed_targets = set(servers)
+    elif changed_targets:
+        # only playlists whose missing tracks were found in the new items
+        # are fetched and written, see the recheck below
+        due = list(sources)
+        playlist_ids = set()
+    else:
+        changed_targets = watcher.wait(scheduler.seconds_until_due())
+        continue
+    logging.info("Starting playlist sync of %s", ", ".join(due))
+
+    targets = {}
+    for name in changed_targets:
+        target = servers[name]()
+        if target is not None:
+            targets[name] = target
+    for target in targets.values():
         try:
-            dz = deezer.Client()
-            DZ_AUTHSUCCESS = True
-        except:
-            logging.info("deezer Authorization error, skipping deezer sync")
+            stale = recheck_missing_tracks(target)
+        except Exception:
+            logging.exception("Missing track recheck on %s failed", target.name)
+            continue
+        if playlist_ids is not None:
+            playlist_ids.update(stale)
 
+    ########## SOURCE SYNC ##########
+    # Each source is bound by its own remote service, run them side by side.
+    # Targets match and write on their own workers, see sync_playlist
+    if not targets:
+        logging.error("Plex or jellyfin auth must be present")
+    elif playlist_ids is not None and not playlist_ids:
+        logging.info("New library items resolved no missing tracks")
     else:
+        with ThreadPoolExecutor(max_workers=len(due)) as executor:
+            durations = {
+                name: executor.submit(
+                    timed,
+                    name,
+                    sources[name],
+                    list(targets.values()),
+                    playlist_ids,
+                )
+                for name in due
+            }
+        for name, duration in durations.items():
+            logging.info("%s sync took %.1fs", name, duration.result())
+            SOURCE_SECONDS.observe(duration.result(), source=name.lower())
+    for target in targets.values():
+        start = time.monotonic()
+        target.close()
         logging.info(
-            "Missing one or more deezer Authorization Variables, skipping"
-            " deezer sync"
+            "%s finished its playlists %.1fs after the sources",
+            target.name,
+            time.monotonic() - start,
         )
-    if DZ_AUTHSUCCESS:
-        deezer_playlist_sync(dz, plex, userInputs)
-        logging.info("Deezer playlist sync complete")
+        record_target_cycle(target)
+        if target.memo.misses:
+            logging.info(
+                "%s matched %s distinct tracks, %.0f%% of lookups"
+                " answered from earlier playlists",
+                target.name,
+                target.memo.misses,
+                target.memo.hit_rate * 100,
+            )
+
+    for name, target in targets.items():
+        watch(name, target)
 
     logging.info("All playlist(s) sync complete")
-    logging.info("sleeping for %s seconds" % userInputs.wait_seconds)
+    wait = scheduler.seconds_until_due()
+    logging.info("sleeping for %.0f seconds" % wait)
 
-    time.sleep(userInputs.wait_seconds)
+    changed_targets = watcher.wait(wait)
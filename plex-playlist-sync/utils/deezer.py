@@ -1,16 +1,36 @@
 import logging
-from typing import List
-
-from plexapi.server import PlexServer
+from typing import Iterator, List, Optional, Set, Tuple
 
 import deezer
+import requests
 
 from .helperClasses import Playlist, Track, UserInputs
-from .plex import update_or_create_plex_playlist
+from .pipeline import fetch_pages, map_ahead
+from .sync import Target, select_playlists, sync_playlist
+from .transport import SessionTransport
+
+
+def new_deezer_client(session: requests.Session) -> deezer.Client:
+    """Return a deezer client sending its requests through a session.
+
+    deezer-python keeps its own httpx connection pool, routing it through
+    the session gives it the pool size, retries and request counting of
+    the other sources.
+
+    Args:
+        session (requests.Session): Session made by ``new_session``
+
+    Returns:
+        deezer.Client: Deezer Client (no credentials needed)
+    """
+    client = deezer.Client()
+    # httpx offers no public way to swap the transport of a built client
+    client._transport = SessionTransport(session)
+    return client
 
 
 def _get_dz_playlists(
-    dz: deezer.Client(),
+    dz: deezer.Client,
     userInputs: UserInputs,
     suffix: str = " - Deezer",
 ) -> List[Playlist]:
@@ -41,7 +61,13 @@ def _get_dz_playlists(
     if userInputs.deezer_playlist_ids:
         try:
             dz_playlist_ids = userInputs.deezer_playlist_ids.split()
-            dz_id_playlists = [dz.get_playlist(id) for id in dz_playlist_ids]
+            dz_id_playlists = list(
+                map_ahead(
+                    dz.get_playlist,
+                    dz_playlist_ids,
+                    userInputs.fetch_concurrency,
+                )
+            )
         except:
             dz_id_playlists = []
             logging.info(
@@ -49,11 +75,15 @@ def _get_dz_playlists(
                 " playlists for IDs"
             )
 
-    dz_playlists = list(set(dz_user_playlists + dz_id_playlists))
+    # a playlist may be both followed and listed by id
+    dz_playlists = {
+        playlist.id: playlist
+        for playlist in dz_user_playlists + dz_id_playlists
+    }
 
     playlists = []
     if dz_playlists:
-        for playlist in dz_playlists:
+        for playlist in dz_playlists.values():
             d = playlist.as_dict()
             playlists.append(
                 Playlist(
@@ -61,23 +91,29 @@ def _get_dz_playlists(
                     name=d["title"] + suffix,
                     description=d.get("description", ""),
                     poster=d.get("picture_big", ""),
+                    change_token=d.get("checksum", ""),
                 )
             )
     return playlists
 
 
 def _get_dz_tracks_from_playlist(
-    dz: deezer.Client(),
+    dz: deezer.Client,
     playlist: Playlist,
-) -> List[Track]:
-    """Return list of tracks with metadata.
+    workers: int = 4,
+) -> Iterator[List[Track]]:
+    """Yield the tracks of a playlist with metadata, one page at a time.
+
+    Tracks are read from the paginated tracks endpoint, the playlist
+    itself is not fetched again.
 
     Args:
         dz (deezer.Client): Deezer Client (no credentials needed)
         playlist (Playlist): Playlist object
+        workers (int): Pages requested at once
 
-    Returns:
-        List[Track]: list of Track objects with track metadata fields
+    Yields:
+        List[Track]: Track objects with track metadata fields of a page
     """
 
     def extract_dz_track_metadata(track):
@@ -86,28 +122,58 @@ def _get_dz_tracks_from_playlist(
         artist = track["artist"]["name"]
         album = track["album"]["title"]
         url = track.get("link", "")
-        return Track(title, artist, album, url)
-
-    dz_playlist_tracks = dz.get_playlist(playlist.id).tracks
-
-    return list(map(extract_dz_track_metadata, dz_playlist_tracks))
+        track_id = str(track.get("id") or "")
+        return Track(
+            title,
+            artist,
+            album,
+            url,
+            isrc=track.get("isrc") or "",
+            # deezer counts in seconds
+            duration=(track.get("duration") or 0) * 1000,
+            provider_ids={"deezer": track_id} if track_id else {},
+        )
+
+    def get_page(limit: int, offset: int) -> Tuple[List, int]:
+        page = dz.request(
+            "GET",
+            f"playlist/{playlist.id}/tracks",
+            paginate_list=True,
+            params={"index": offset, "limit": limit},
+        )
+        return page["data"], page.get("total", 0)
+
+    for page in fetch_pages(get_page, 100, workers):
+        yield list(map(extract_dz_track_metadata, page))
 
 
 def deezer_playlist_sync(
-    dz: deezer.Client(), plex: PlexServer, userInputs: UserInputs
+    dz: deezer.Client,
+    targets: List[Target],
+    userInputs: UserInputs,
+    playlist_ids: Optional[Set[str]] = None,
 ) -> None:
-    """Create/Update plex playlists with playlists from deezer.
+    """Create/Update plex and jellyfin playlists with playlists from deezer.
 
     Args:
         dz (deezer.Client):  Deezer Client (no credentials needed)
-        plex (PlexServer): A configured PlexServer instance
+        targets (List[Target]): plex and jellyfin servers prepared for the
+            cycle
+        playlist_ids (Set[str], optional): Only sync these playlists
     """
     playlists = _get_dz_playlists(
         dz, userInputs, " - Deezer" if userInputs.append_service_suffix else ""
     )
     if playlists:
-        for playlist in playlists:
-            tracks = _get_dz_tracks_from_playlist(dz, playlist)
-            update_or_create_plex_playlist(plex, playlist, tracks, userInputs)
+        for playlist in select_playlists(playlists, playlist_ids):
+            sync_playlist(
+                playlist,
+                lambda p: _get_dz_tracks_from_playlist(
+                    dz, p, userInputs.fetch_concurrency
+                ),
+                targets,
+                userInputs,
+                "deezer",
+            )
     else:
         logging.error("No deezer playlists found for given user")
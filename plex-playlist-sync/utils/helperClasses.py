@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Dict, List
 
 
 @dataclass
@@ -7,6 +8,12 @@ class Track:
     artist: str
     album: str
     url: str
+    # International Standard Recording Code, "" if the source has none
+    isrc: str = ""
+    # length in milliseconds, 0 if unknown
+    duration: int = 0
+    # provider name to the track id on that provider, e.g. {"spotify": id}
+    provider_ids: Dict[str, str] = field(default_factory=dict)
 
 
 @dataclass
@@ -15,12 +22,16 @@ class Playlist:
     name: str
     description: str
     poster: str
+    # changes whenever the source playlist changes, "" if unknown
+    change_token: str = ""
 
 
 @dataclass
 class UserInputs:
-    plex_url: str
-    plex_token: str
+    # one entry per server, a single token applies to every server
+    plex_urls: List[str]
+    plex_tokens: List[str]
+    plex_index_page_size: int
 
     write_missing_as_csv: bool
     append_service_suffix: bool
@@ -28,6 +39,23 @@ class UserInputs:
     add_playlist_description: bool
     append_instead_of_sync: bool
     wait_seconds: int
+    spotify_wait_seconds: int
+    ytmusic_wait_seconds: int
+    deezer_wait_seconds: int
+    schedule_jitter: float
+    playlist_intervals: Dict[str, int]
+    library_poll_seconds: int
+    metrics_port: int
+    data_dir: str
+    match_cache: bool
+    match_cache_negative_ttl: int
+    skip_unchanged_playlists: bool
+    match_concurrency: int
+    target_concurrency: int
+    fetch_concurrency: int
+    http_pool_size: int
+    http_retries: int
+    http_backoff_factor: float
 
     spotipy_client_id: str
     spotipy_client_secret: str
@@ -36,8 +64,13 @@ class UserInputs:
     deezer_user_id: str
     deezer_playlist_ids: str
 
-    jellyfin_url: str
-    jellyfin_token: str
-    jellyfin_user: str
+    jellyfin_urls: List[str]
+    jellyfin_tokens: List[str]
+    jellyfin_users: List[str]
+    jellyfin_library_snapshot: bool
+    jellyfin_snapshot_page_size: int
+    jellyfin_playlist_batch_size: int
 
     yt_music_auth_file: str
+    ytmusic_concurrency: int
+    ytmusic_requests_per_second: float
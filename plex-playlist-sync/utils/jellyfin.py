@@ -1,98 +1,353 @@
-import csv
 import json
 import logging
-import pathlib
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from difflib import SequenceMatcher
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
-import plexapi
+import plexapi.playlist
+from jellyfinapi.jellyfinapi_client import JellyfinapiClient
 
 from .helperClasses import Playlist, Track, UserInputs
+from .matching import LibraryIndex, resolve_tracks, same_length
+from .reconcile import plan_playlist_changes
+from .store import SyncStore
+from .target import IDS_PER_REQUEST, SyncTarget
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
+# provider ids naming a single recording, album and artist ids are shared
+# by many tracks
+_RECORDING_PROVIDERS = {"isrc", "musicbrainztrack", "musicbrainzrecording"}
 
-def _write_csv(tracks: List[Track], name: str, path: str = "/data") -> None:
-    """Write given tracks with given name as a csv.
+
+def build_jellyfin_library_index(
+    jellyfin: JellyfinapiClient, page_size: int = 1000
+) -> LibraryIndex:
+    """Snapshot every Audio item of the jellyfin library into an index.
+
+    Items are paged through once with images, user data and optional fields
+    other than the provider ids disabled, leaving only the name, artists,
+    album, id, runtime and provider ids such as the ISRC.
 
     Args:
-        tracks (List[Track]): List of Track objects
-        name (str): Name of the file to write
-        path (str): Root directory to write the file
+        jellyfin (JellyfinapiClient): A configured jellyfin client
+        page_size (int): Number of items requested per page
+
+    Returns:
+        LibraryIndex: index of jellyfin item ids
     """
-    # pathlib.Path(path).mkdir(parents=True, exist_ok=True)
-
-    data_folder = pathlib.Path(path)
-    data_folder.mkdir(parents=True, exist_ok=True)
-    file = data_folder / f"{name}.csv"
-
-    with open(file, "w", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(Track.__annotations__.keys())
-        for track in tracks:
-            writer.writerow(
-                [track.title, track.artist, track.album, track.url]
+    start = time.monotonic()
+    index = _index_audio_items(jellyfin, page_size)
+    logging.info(
+        "Snapshot of %s jellyfin audio items took %.1fs",
+        index.size,
+        time.monotonic() - start,
+    )
+    return index
+
+
+def _recording_ids(item) -> Dict[str, str]:
+    """Return the provider ids of an audio item that identify its recording."""
+    ids = getattr(item, "provider_ids", None) or {}
+    return {
+        provider: value
+        for provider, value in ids.items()
+        if provider.lower() in _RECORDING_PROVIDERS
+    }
+
+
+def _milliseconds(ticks: Optional[int]) -> int:
+    """Convert a jellyfin runtime, counted in 100ns ticks."""
+    return (ticks or 0) // 10000
+
+
+def _index_audio_items(
+    jellyfin: JellyfinapiClient, page_size: int, **filters
+) -> LibraryIndex:
+    """Page through the Audio items matching the filters into an index."""
+    index = LibraryIndex()
+    start_index, total = 0, None
+    while total is None or start_index < total:
+        result = jellyfin.items.get_items(
+            recursive=True,
+            include_item_types="Audio",
+            sort_by="SortName",
+            start_index=start_index,
+            limit=page_size,
+            enable_images=False,
+            enable_user_data=False,
+            enable_total_record_count=total is None,
+            fields="ProviderIds",
+            **filters,
+        )
+        if total is None:
+            total = result.total_record_count or 0
+        items = result.items or []
+        if not items:
+            break
+        for item in items:
+            # jellyfin leaves empty fields out, jellyfinapi then never sets
+            # the attribute
+            index.add(
+                item.id,
+                getattr(item, "name", None) or "",
+                [
+                    getattr(item, "album_artist", None),
+                    *(getattr(item, "artists", None) or []),
+                ],
+                getattr(item, "album", None) or "",
+                duration=_milliseconds(getattr(item, "run_time_ticks", None)),
+                ids=_recording_ids(item),
             )
+        start_index += len(items)
+    return index
 
 
-def _delete_csv(name: str, path: str = "/data") -> None:
-    """Delete file associated with given name
+def jellyfin_library_generation(jellyfin: JellyfinapiClient) -> str:
+    """Return a value that changes whenever audio items are added or removed.
+
+    Built from the audio item count and the most recently created item,
+    which costs a single request.
+    """
+    result = jellyfin.items.get_items(
+        recursive=True,
+        include_item_types="Audio",
+        sort_by="DateCreated",
+        sort_order="Descending",
+        limit=1,
+        enable_images=False,
+        enable_user_data=False,
+        enable_total_record_count=True,
+    )
+    latest = result.items[0].id if result.items else ""
+    return f"{result.total_record_count}:{latest}"
+
+
+@dataclass
+class JellyfinSession:
+    """The jellyfin user being synced and the playlists it already has."""
+
+    user_id: str
+    # playlist name to playlist id
+    playlists: Dict[str, str]
+
+
+def _open_session(
+    jellyfin: JellyfinapiClient, user_name: str
+) -> JellyfinSession:
+    """Resolve the user id and index the user's playlists by name.
 
     Args:
-        name (str): Name of the file to delete
-        path (str, optional): Root directory to delete the file from
+        jellyfin (JellyfinapiClient): A configured jellyfin client
+        user_name (str): Name of the jellyfin user owning the playlists
+
+    Returns:
+        JellyfinSession: user id and playlist name index
     """
-    data_folder = pathlib.Path(path)
-    file = data_folder / f"{name}.csv"
-    file.unlink()
-
-
-def _get_available_jellyfin_tracks(jellyfin, tracks: List[Track], userinputs) -> List:
-
-    jellyfin_tracks, missing_tracks = [], []
-    for track in tracks:
-        search = []
-        try:
-            if track.title != "":
-                # logging.info("searching for ", track.title)
-                search = jellyfin.search.get(track.title, None, None, None, "Audio", None, "Audio", None, None, None, None, None, None, False, True, False, False, True)
-        except Exception:
-            logging.info("failed to search %s on jellyfin", track.title)
-        found = False
-        if search:
-            for s in search.search_hints:
-                try:
-                    #jellyfin search is not strict, continue to next index if track name does no match
-                    track_similarity = SequenceMatcher(None, s.name.lower(), track.title.lower()).quick_ratio()
-                    if track_similarity <= 0.9:
-                        continue
-
-                    if hasattr(s, 'album_artist') != None:
-                        artist_similarity = SequenceMatcher(None, s.album_artist.lower(), track.artist.lower()).quick_ratio()
-                        if artist_similarity >= 0.9:
-                            jellyfin_tracks.append(s.id)
-                            found = True
-                            break
-
-                    if s.album != None:
-                        album_similarity = SequenceMatcher(None, s.album.lower(), track.album.lower()).quick_ratio()
-                        if album_similarity >= 0.9:
-                            jellyfin_tracks.append(s.id)
-                            found = True
-                            break
-
-                except IndexError:
-                    logging.info(
-                        "Looks like jellyfin mismatched the search for %s,"
-                        " retrying with next result"
-                    )
-        if not found:
-            # download_song(userinputs, track)
-            missing_tracks.append(track)
-
-    return jellyfin_tracks, missing_tracks
+    users = jellyfin.user.get_users()
+    user_id = next((user.id for user in users if user.name == user_name), None)
+    if user_id is None:
+        raise ValueError("User not found")
+
+    result = jellyfin.items.get_items(
+        user_id=user_id,
+        recursive=True,
+        include_item_types="Playlist",
+        enable_images=False,
+        enable_user_data=False,
+    )
+    playlists = {}
+    for item in result.items or []:
+        playlists.setdefault(item.name, item.id)
+    return JellyfinSession(user_id=user_id, playlists=playlists)
+
+
+class JellyfinTarget(SyncTarget):
+    """A jellyfin server together with the state built for the current cycle.
+
+    The user session is loaded on first use like the library snapshot, so
+    a cycle in which every playlist is unchanged never lists users and
+    playlists. ``index`` is None when the snapshot is disabled, tracks are
+    then matched with one search request each.
+
+    Attributes:
+        generation (str): Changes whenever audio items are added or removed
+    """
+
+    def __init__(
+        self,
+        client: JellyfinapiClient,
+        url: str,
+        user_name: str,
+        userInputs: UserInputs,
+        store: Optional[SyncStore] = None,
+    ) -> None:
+        super().__init__(f"jellyfin:{url}", userInputs, store)
+        self.client = client
+        self.generation = jellyfin_library_generation(client)
+        self._snapshot = userInputs.jellyfin_library_snapshot
+        self._page_size = userInputs.jellyfin_snapshot_page_size
+        self._user_name = user_name
+        self._session = None
+        self._session_lock = threading.Lock()
+        # bounds the concurrent search requests sent to this server
+        self.executor = None
+        if not self._snapshot and userInputs.match_concurrency > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=userInputs.match_concurrency,
+                thread_name_prefix="jellyfin-match",
+            )
+
+    def _build_index(self) -> Optional[LibraryIndex]:
+        if not self._snapshot:
+            return None
+        return build_jellyfin_library_index(self.client, self._page_size)
+
+    @property
+    def session(self) -> JellyfinSession:
+        # playlists created during the cycle are added to this session
+        with self._session_lock:
+            if self._session is None:
+                self._session = _open_session(self.client, self._user_name)
+        return self._session
+
+    def close(self) -> None:
+        """Wait for the queued playlists, then release the worker threads."""
+        super().close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def existing(self, item_ids: List[str]) -> Set[str]:
+        """Return which of the given item ids are still in the library.
+
+        Answered from the snapshot once it is taken, otherwise the ids are
+        looked up directly, one request per 100 ids.
+
+        Args:
+            item_ids (List[str]): jellyfin item ids
+
+        Returns:
+            Set[str]: the ids of items that still exist
+        """
+        index = self._built_index()
+        if index is not None:
+            return {item_id for item_id in item_ids if item_id in index}
+        found = set()
+        for start in range(0, len(item_ids), IDS_PER_REQUEST):
+            result = self.client.items.get_items(
+                ids=",".join(item_ids[start : start + IDS_PER_REQUEST]),
+                enable_images=False,
+                enable_user_data=False,
+            )
+            found.update(item.id for item in result.items or [])
+        return found
+
+    def recently_added(self, since: float) -> LibraryIndex:
+        """Index the audio items added or changed since a time.
+
+        Args:
+            since (float): unix time
+
+        Returns:
+            LibraryIndex: index of the new jellyfin item ids
+        """
+        return _index_audio_items(
+            self.client,
+            self._page_size,
+            min_date_last_saved=datetime.fromtimestamp(since, timezone.utc),
+        )
+
+    def match(
+        self, tracks: List[Track]
+    ) -> Tuple[List[str], List[Track], List[Track]]:
+        """Resolve tracks to jellyfin item ids.
+
+        Args:
+            tracks (List[Track]): list of track objects
+
+        Returns:
+            Tuple[List[str], List[Track], List[Track]]: item ids, missing
+            tracks and tracks whose matching failed
+        """
+        return _get_available_jellyfin_tracks(self, tracks)
+
+
+def _search_jellyfin_track(jellyfin: JellyfinapiClient, track: Track) -> Optional[str]:
+    """Find the jellyfin item id of a track with a search request."""
+    search = []
+    try:
+        if track.title != "":
+            # logging.info("searching for ", track.title)
+            search = jellyfin.search.get(track.title, None, None, None, "Audio", None, "Audio", None, None, None, None, None, None, False, True, False, False, True)
+    except Exception:
+        logging.info("failed to search %s on jellyfin", track.title)
+        # not a miss, the track is matched again next cycle
+        raise
+    if search:
+        for s in search.search_hints:
+            try:
+                #jellyfin search is not strict, continue to next index if track name does no match
+                track_similarity = SequenceMatcher(None, s.name.lower(), track.title.lower()).quick_ratio()
+                if track_similarity <= 0.9:
+                    continue
+                # another version of the track, e.g. a live recording
+                if not same_length(
+                    track.duration,
+                    _milliseconds(getattr(s, "run_time_ticks", None)),
+                ):
+                    continue
+
+                album_artist = getattr(s, "album_artist", None)
+                if album_artist:
+                    artist_similarity = SequenceMatcher(None, album_artist.lower(), track.artist.lower()).quick_ratio()
+                    if artist_similarity >= 0.9:
+                        return s.id
+
+                album = getattr(s, "album", None)
+                if album:
+                    album_similarity = SequenceMatcher(None, album.lower(), track.album.lower()).quick_ratio()
+                    if album_similarity >= 0.9:
+                        return s.id
+
+            except IndexError:
+                logging.info(
+                    "Looks like jellyfin mismatched the search for %s,"
+                    " retrying with next result"
+                )
+    return None
+
+
+def _get_available_jellyfin_tracks(
+    jellyfin: JellyfinTarget, tracks: List[Track]
+) -> Tuple[List[str], List[Track]]:
+
+    def match(track):
+        # the snapshot is only taken once a track is not in the cache
+        if jellyfin.index is not None:
+            return jellyfin.index.match(track)
+        return _search_jellyfin_track(jellyfin.client, track)
+
+    jellyfin_tracks, missing_tracks, failed_tracks = resolve_tracks(
+        tracks,
+        jellyfin.memo.memoize(match),
+        jellyfin.cache,
+        jellyfin.existing,
+        jellyfin.executor,
+        # the snapshot is taken once per page, not once per track when it
+        # fails
+        prepare=lambda: jellyfin.index,
+    )
+    if jellyfin.cache is not None:
+        jellyfin.cache.flush()
+    # for track in missing_tracks: download_song(userinputs, track)
+
+    return jellyfin_tracks, missing_tracks, failed_tracks
 
 def download_song(userinputs: UserInputs, track):
     command = ("ytmdl -q -o '/home/muhumbulom/PycharmProjects/plex-playlist-sync/download$Artist->Album->[Title]' --spotify-id '"
@@ -135,66 +390,129 @@ def sync_list_with_jellyfin_playlist(client = None, title = None, inputList = No
     else:
         print(response)
 
-def _update_playlist(jellyfin, playlistId, tracks, user_id):
-    batch_size = 100
-    for i in range(0, len(tracks), batch_size):
-        batch = tracks[i:i + batch_size]
-        jellyfin.playlists.add_to_playlist(playlistId, ",".join(batch), user_id)
+def _get_playlist_entries(
+    jellyfin: JellyfinapiClient,
+    playlist_id: str,
+    user_id: str,
+    page_size: int = 1000,
+) -> List:
+    """Return the entries of a jellyfin playlist, in order.
+
+    Args:
+        jellyfin (JellyfinapiClient): A configured jellyfin client
+        playlist_id (str): Id of the playlist
+        user_id (str): Id of the user owning the playlist
+        page_size (int): Number of entries requested per page
+
+    Returns:
+        List: playlist items, ``playlist_item_id`` identifies the entry
+    """
+    entries = []
+    while True:
+        result = jellyfin.playlists.get_playlist_items(
+            playlist_id,
+            user_id,
+            start_index=len(entries),
+            limit=page_size,
+            enable_images=False,
+            enable_user_data=False,
+        )
+        items = result.items or []
+        entries.extend(items)
+        if len(items) < page_size:
+            return entries
+
+
+def _update_playlist(
+    jellyfin: JellyfinapiClient,
+    playlist_id: str,
+    item_ids: List[str],
+    user_id: str,
+    append: bool = False,
+    batch_size: int = 100,
+) -> None:
+    """Sync a jellyfin playlist with the given items.
+
+    Only the necessary removes, adds and moves are sent, nothing is written
+    when the playlist already holds the items in order. Removes and adds
+    are sent ``batch_size`` ids per request.
+
+    Args:
+        jellyfin (JellyfinapiClient): A configured jellyfin client
+        playlist_id (str): Id of the playlist
+        item_ids (List[str]): Jellyfin item ids wanted, in order
+        user_id (str): Id of the user owning the playlist
+        append (bool): Boolean for Append or sync
+        batch_size (int): Number of ids sent per request
+    """
+    entries = _get_playlist_entries(jellyfin, playlist_id, user_id)
+    changes = plan_playlist_changes(
+        [entry.id for entry in entries], item_ids, append
+    )
+    if not changes:
+        logging.info("Playlist %s is already up to date", playlist_id)
+        return
+
+    stale = [entries[pos].playlist_item_id for pos in changes.remove]
+    for i in range(0, len(stale), batch_size):
+        jellyfin.playlists.remove_from_playlist(
+            playlist_id, ",".join(stale[i : i + batch_size])
+        )
+    for i in range(0, len(changes.add), batch_size):
+        jellyfin.playlists.add_to_playlist(
+            playlist_id, ",".join(changes.add[i : i + batch_size]), user_id
+        )
+    if changes.moves:
+        entries = _get_playlist_entries(jellyfin, playlist_id, user_id)
+        entry_ids = {entry.id: entry.playlist_item_id for entry in entries}
+        # jellyfin moves to an absolute index, track the order locally
+        order = [entry.id for entry in entries]
+        for key, after in changes.moves:
+            order.remove(key)
+            new_index = order.index(after) + 1 if after is not None else 0
+            order.insert(new_index, key)
+            jellyfin.playlists.move_item(
+                playlist_id, entry_ids[key], new_index
+            )
+    logging.info(
+        "Playlist %s: removed %s, added %s, moved %s tracks",
+        playlist_id,
+        len(changes.remove),
+        len(changes.add),
+        len(changes.moves),
+    )
+
 
 def update_or_create_jellyfin_playlist(
-    jellyfin,
+    target: JellyfinTarget,
     playlist: Playlist,
-    tracks: List[Track],
+    available_tracks: List[str],
+    missing_tracks: List[Track],
     userInputs: UserInputs,
 ) -> None:
 
-    users = jellyfin.user.get_users()
-    user_id = next((user.id for user in users if user.name == userInputs.jellyfin_user), None)
-    if user_id is None:
-        raise ValueError("User not found")
-
-    available_tracks, missing_tracks = _get_available_jellyfin_tracks(jellyfin, tracks, userInputs)
+    jellyfin = target.client
     if available_tracks:
-        search = jellyfin.search.get(playlist.name, None, None, user_id, "Playlist", None, "Audio", None, None, None, None, None,
-                                     None, False, True, False, False, True)
-        if search and len(search.search_hints) > 0:
-            for s in search.search_hints:
-                # jellyfin search is not strict, continue to next index if playlist name does no match
-                track_similarity = SequenceMatcher(None, s.name.lower(), playlist.name.lower()).quick_ratio()
-                if track_similarity >= 0.9:
-                    _update_playlist(jellyfin, s.id, available_tracks, user_id)
-                    logging.info("Updated playlist %s with summary and poster", playlist.name)
-                else:
-                    continue
-        else:
-            playlist_id = jellyfin.playlists.create_playlist(playlist.name, "", user_id, "Audio")
+        session = target.session
+        playlist_id = session.playlists.get(playlist.name)
+        if playlist_id is None:
+            playlist_id = jellyfin.playlists.create_playlist(
+                playlist.name, "", session.user_id, "Audio"
+            ).id
+            session.playlists[playlist.name] = playlist_id
             logging.info("Created playlist %s", playlist.name)
-            _update_playlist(jellyfin, playlist_id.id, available_tracks, user_id)
-            logging.info("Updated playlist %s with summary and poster", playlist.name)
+        _update_playlist(
+            jellyfin,
+            playlist_id,
+            available_tracks,
+            session.user_id,
+            append=userInputs.append_instead_of_sync,
+            batch_size=userInputs.jellyfin_playlist_batch_size,
+        )
+        logging.info("Updated playlist %s", playlist.name)
     else:
         logging.info(
             "No songs for playlist %s were found on jellyfin, skipping the"
             " playlist creation",
             playlist.name,
         )
-
-    if missing_tracks and userInputs.write_missing_as_csv:
-        try:
-            _write_csv(missing_tracks, playlist.name)
-            logging.info("Missing tracks written to %s.csv", playlist.name)
-        except:
-            logging.info(
-                "Failed to write missing tracks for %s, likely permission"
-                " issue",
-                playlist.name,
-            )
-    if (not missing_tracks) and userInputs.write_missing_as_csv:
-        try:
-            # Delete playlist created in prev run if no tracks are missing now
-            _delete_csv(playlist.name)
-            logging.info("Deleted old %s.csv", playlist.name)
-        except:
-            logging.info(
-                "Failed to delete %s.csv, likely permission issue",
-                playlist.name,
-            )
@@ -0,0 +1,441 @@
+import logging
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import Executor
+from difflib import SequenceMatcher
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Container,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
+
+from .helperClasses import Track
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+MATCH_THRESHOLD = 0.9
+TITLE_THRESHOLD = 0.8
+# milliseconds two lengths of the same recording may differ by, a longer
+# gap means another version such as a live take or an extended mix
+DURATION_TOLERANCE = 10000
+
+# words that decorate a title or name without telling tracks apart
+_NOISE_WORDS = frozenset(
+    {"a", "and", "feat", "featuring", "ft", "remaster", "remastered", "the"}
+)
+_SUFFIX = re.compile(r"\s[-\u2013\u2014]\s|[(\[]")
+_APOSTROPHES = re.compile(r"['\u2019]")
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase text and strip accents, punctuation and extra whitespace.
+
+    Args:
+        text (str): Title, artist or album name
+
+    Returns:
+        str: normalized text, "" for empty values
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = _APOSTROPHES.sub("", text.lower())
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def base_title(title: str) -> str:
+    """Return the title without suffixes like "(Remastered)" or "- Live".
+
+    Args:
+        title (str): Track title
+
+    Returns:
+        str: title up to the first bracket or dash separator, the whole
+            title when nothing precedes it
+    """
+    return _SUFFIX.split(title, 1)[0].strip() or title
+
+
+def _id_key(provider: str, value: str) -> Tuple[str, str]:
+    """Compare provider ids regardless of case, e.g. "ISRC" and "isrc"."""
+    return provider.lower(), str(value).strip().lower()
+
+
+def _track_ids(track: Track) -> Iterator[Tuple[str, str]]:
+    """Yield the normalized (provider, id) pairs known for a track."""
+    if track.isrc:
+        yield _id_key("isrc", track.isrc)
+    for provider, value in track.provider_ids.items():
+        if value:
+            yield _id_key(provider, value)
+
+
+def same_length(a: int, b: int) -> bool:
+    """Tell whether two durations in milliseconds fit the same recording.
+
+    Unknown durations (0) match anything.
+    """
+    return not (a and b) or abs(a - b) <= DURATION_TOLERANCE
+
+
+def _tokens(text: str) -> FrozenSet[str]:
+    """Split normalized text into words, dropping decoration words."""
+    words = frozenset(text.split())
+    return (words - _NOISE_WORDS) or words
+
+
+def _dice(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def _similarity(
+    a: str, a_tokens: FrozenSet[str], b: str, b_tokens: FrozenSet[str]
+) -> float:
+    """Score two normalized names, word overlap first then characters."""
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    score = _dice(a_tokens, b_tokens)
+    if score >= MATCH_THRESHOLD:
+        return score
+    # catches typos and spacing differences inside words
+    return max(score, SequenceMatcher(None, a, b).quick_ratio())
+
+
+class LibraryIndex:
+    """Matching engine over the tracks of a server library.
+
+    Built once per cycle from bulk listings of the server library so that
+    matching a source track needs no network round trip. Tracks are
+    identified by their server key (plex ratingKey, jellyfin item id).
+
+    Titles, artists and albums are normalized and tokenized once when
+    added. Lookups try the ISRC and provider ids of the track first, then
+    an exact (title, artist, album) key, then gather candidates from an
+    inverted index of title words, narrow them to the ones sharing an
+    artist word, and return the best scoring one. Name based matches are
+    rejected when both durations are known and too far apart.
+    """
+
+    def __init__(self) -> None:
+        self._items = {}
+        self._ids = {}
+        self._exact = {}
+        self._keys = []
+        self._titles = []
+        self._artists = []
+        self._albums = []
+        self._durations = []
+        self._title_postings = defaultdict(list)
+
+    @property
+    def size(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the server object stored for the given key."""
+        return self._items.get(key)
+
+    def keys(self) -> Iterable[str]:
+        return self._items.keys()
+
+    def add(
+        self,
+        key: str,
+        title: str,
+        artists: Iterable[str],
+        album: str,
+        item: Any = None,
+        duration: int = 0,
+        ids: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Add a server track to the index.
+
+        Args:
+            key (str): Server key of the track
+            title (str): Track title
+            artists (Iterable[str]): Artist names credited on the track
+            album (str): Album title
+            item (Any): Server object kept for the key, defaults to the key
+            duration (int): Length in milliseconds, 0 if unknown
+            ids (Dict[str, str], optional): provider name to an id naming
+                this recording alone, e.g. {"ISRC": ...}, matched against
+                the ids of a track. Album or artist ids would resolve
+                every track sharing them to the first one added
+        """
+        self._items[key] = key if item is None else item
+        for provider, value in (ids or {}).items():
+            if value:
+                self._ids.setdefault(_id_key(provider, value), key)
+        artists = {normalize(a) for a in artists if a}
+        album = normalize(album)
+        full = normalize(title)
+        base = normalize(base_title(title))
+
+        entry = len(self._keys)
+        self._keys.append(key)
+        self._titles.append((_tokens(full), _tokens(base)))
+        self._artists.append(tuple((a, _tokens(a)) for a in artists))
+        self._albums.append((album, _tokens(album)))
+        self._durations.append(duration or 0)
+        for word in self._titles[entry][0] | self._titles[entry][1]:
+            self._title_postings[word].append(entry)
+        for artist in artists:
+            self._exact.setdefault((full, artist, album), entry)
+
+    def _candidates(
+        self, words: FrozenSet[str], artist_words: FrozenSet[str]
+    ) -> Iterable[int]:
+        """Block the library down to entries worth scoring.
+
+        Entries must share one of the two rarest title words and, when any
+        does, an artist word as well.
+        """
+        postings = sorted(
+            (self._title_postings[w] for w in words if w in self._title_postings),
+            key=len,
+        )
+        candidates = set().union(*postings[:2])
+        if artist_words:
+            same_artist = [
+                entry
+                for entry in candidates
+                if any(artist_words & a[1] for a in self._artists[entry])
+            ]
+            if same_artist:
+                return same_artist
+        return candidates
+
+    def match(self, track: Track) -> Optional[str]:
+        """Return the key of the indexed track best matching the given track.
+
+        A track sharing an ISRC or provider id with an indexed track
+        resolves to it directly. Otherwise a candidate needs a length
+        within ``DURATION_TOLERANCE``, a similar title and a similar artist
+        or album. Candidates whose full title is similar rank above those
+        only similar without suffixes, so "Hello" prefers "Hello" over
+        "Hello - Live" and the other way round. Within a rank, the highest
+        scoring one wins.
+
+        Args:
+            track (Track): Track object
+
+        Returns:
+            Optional[str]: matched key, None if nothing matched
+        """
+        for track_id in _track_ids(track):
+            key = self._ids.get(track_id)
+            if key is not None:
+                return key
+
+        title = normalize(track.title)
+        artist = normalize(track.artist)
+        album = normalize(track.album)
+
+        entry = self._exact.get((title, artist, album))
+        if entry is not None and same_length(
+            track.duration, self._durations[entry]
+        ):
+            return self._keys[entry]
+
+        titles = (_tokens(title), _tokens(normalize(base_title(track.title))))
+        artist_words, album_words = _tokens(artist), _tokens(album)
+        best, best_score = None, (0, 0.0)
+        for entry in self._candidates(titles[1], artist_words):
+            if not same_length(track.duration, self._durations[entry]):
+                continue
+            rank, title_score = 1, _dice(titles[0], self._titles[entry][0])
+            if title_score < TITLE_THRESHOLD:
+                # only the titles without suffixes agree, another version
+                rank, title_score = 0, max(
+                    _dice(a, b) for a in titles for b in self._titles[entry]
+                )
+                if title_score < TITLE_THRESHOLD:
+                    continue
+            artist_score = max(
+                (
+                    _similarity(artist, artist_words, *candidate)
+                    for candidate in self._artists[entry]
+                ),
+                default=0.0,
+            )
+            album_score = _similarity(album, album_words, *self._albums[entry])
+            if max(artist_score, album_score) < MATCH_THRESHOLD:
+                continue
+            score = (rank, title_score + artist_score + album_score / 2)
+            if best is None or score > best_score:
+                best, best_score = self._keys[entry], score
+        return best
+
+
+class ResolutionMemo:
+    """Results of matching during one cycle, shared by every playlist.
+
+    Keyed on the normalized (title, artist, album) so a track appearing in
+    several playlists or sources is matched once per target per cycle.
+    """
+
+    def __init__(self) -> None:
+        self._results = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def memoize(
+        self, match: Callable[[Track], Optional[str]]
+    ) -> Callable[[Track], Optional[str]]:
+        """Wrap a matcher so each distinct track is only matched once.
+
+        Args:
+            match (Callable): Returns the server key for a track or None
+
+        Returns:
+            Callable: matcher answering repeated tracks from the memo
+        """
+
+        def memoized(track: Track) -> Optional[str]:
+            key = (
+                normalize(track.title),
+                normalize(track.artist),
+                normalize(track.album),
+            )
+            with self._lock:
+                if key in self._results:
+                    self.hits += 1
+                    return self._results[key]
+            result = match(track)
+            with self._lock:
+                self._results[key] = result
+                self.misses += 1
+            return result
+
+        return memoized
+
+
+def _safe_match(
+    match: Callable[[Track], Optional[str]], track: Track
+) -> Tuple[Optional[str], Optional[Exception]]:
+    try:
+        return match(track), None
+    except Exception as e:
+        return None, e
+
+
+def resolve_tracks(
+    tracks: List[Track],
+    match: Callable[[Track], Optional[str]],
+    cache: Optional[MutableMapping[str, Optional[str]]] = None,
+    existing: Optional[Callable[[List[str]], Container[str]]] = None,
+    executor: Optional[Executor] = None,
+    prepare: Optional[Callable[[], Any]] = None,
+) -> Tuple[List[str], List[Track], List[Track]]:
+    """Resolve tracks to server keys, consulting the match cache first.
+
+    The cached keys of all tracks are checked in one ``existing`` call,
+    keys no longer on the server are dropped and the track is matched
+    again. Fresh results, including misses, are cached under the track's
+    source id (``Track.url``). A track whose matching raised is reported
+    as failed, apart from the missing ones, and is not cached.
+
+    Args:
+        tracks (List[Track]): list of track objects
+        match (Callable): Returns the server key for a track or None
+        cache (MutableMapping, optional): Source id to server key cache
+        existing (Callable, optional): Returns which of the given keys are
+            still on the server, cached keys are trusted without it
+        executor (Executor, optional): Pool running ``match`` concurrently,
+            results keep the order of ``tracks``
+        prepare (Callable, optional): Called once before the first track
+            is matched, e.g. to build the library index. When it raises,
+            every track left to match fails with its error
+
+    Returns:
+        Tuple[List[str], List[Track], List[Track]]: server keys, missing
+        tracks and tracks whose matching failed
+    """
+    keys = [None] * len(tracks)
+    failed = set()
+    pending, cached = [], []
+    for pos, track in enumerate(tracks):
+        source_id = track.url if cache is not None else ""
+        if source_id and source_id in cache:
+            keys[pos] = cache[source_id]
+            cached.append(pos)
+        else:
+            pending.append(pos)
+
+    cached_keys = list({keys[pos] for pos in cached} - {None})
+    if existing is not None and cached_keys:
+        present = existing(cached_keys)
+        for pos in cached:
+            if keys[pos] is not None and keys[pos] not in present:
+                cache.pop(tracks[pos].url, None)
+                keys[pos] = None
+                pending.append(pos)
+
+    start = time.monotonic()
+    to_match = [tracks[pos] for pos in pending]
+    try:
+        if to_match and prepare is not None:
+            prepare()
+    except Exception as e:
+        logging.info("Failed to prepare matching: %s", e)
+        results = [(None, e)] * len(to_match)
+    else:
+        if executor is not None:
+            results = executor.map(partial(_safe_match, match), to_match)
+        else:
+            results = map(partial(_safe_match, match), to_match)
+    for pos, (key, error) in zip(pending, results):
+        track = tracks[pos]
+        if error is not None:
+            logging.info("Failed to match %s: %s", track.title, error)
+            failed.add(pos)
+            continue
+        keys[pos] = key
+        if cache is not None and track.url:
+            cache[track.url] = key
+
+    if pending:
+        elapsed = time.monotonic() - start
+        logging.info(
+            "Matched %s tracks in %.1fs (%.0f tracks/s)",
+            len(pending),
+            elapsed,
+            len(pending) / elapsed if elapsed else float("inf"),
+        )
+    found = [key for key in keys if key is not None]
+    missing = [
+        track
+        for pos, (track, key) in enumerate(zip(tracks, keys))
+        if key is None and pos not in failed
+    ]
+    return found, missing, [tracks[pos] for pos in sorted(failed)]
@@ -0,0 +1,236 @@
+import logging
+import sys
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from .transport import request_counters
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+# seconds, from a cached lookup up to a full library listing
+_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"'
+    )
+
+
+def _labels(names: Sequence[str], values: Sequence[str], **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.label_names, key)} {value}"
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. requests sent."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. a hit ratio."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. durations in seconds."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = _BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self) -> Iterable[str]:
+        with self._lock:
+            values = {k: (list(c), t) for k, (c, t) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _labels(self.label_names, key, le=bound)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+REGISTRY: List[_Metric] = []
+
+PHASE_SECONDS = Histogram(
+    "plexsync_phase_seconds",
+    "Time spent per playlist fetching from a source, matching on and"
+    " writing to a target",
+    ["phase", "source", "target"],
+)
+SOURCE_SECONDS = Histogram(
+    "plexsync_source_sync_seconds",
+    "Wall time of a source sync",
+    ["source"],
+)
+PLAYLISTS = Counter(
+    "plexsync_playlists_total",
+    "Playlists processed, by outcome",
+    ["source", "target", "result"],
+)
+TRACKS = Counter(
+    "plexsync_tracks_total",
+    "Source tracks matched, found or missing on the target",
+    ["source", "target", "result"],
+)
+CACHE_LOOKUPS = Counter(
+    "plexsync_match_cache_lookups_total",
+    "Match cache lookups, by hit or miss",
+    ["target", "result"],
+)
+CACHE_HIT_RATIO = Gauge(
+    "plexsync_match_cache_hit_ratio",
+    "Share of match cache lookups answered during the last cycle",
+    ["target"],
+)
+MEMO_LOOKUPS = Counter(
+    "plexsync_match_memo_lookups_total",
+    "Track matches answered from earlier playlists of the same cycle (hit)"
+    " or matched (miss)",
+    ["target", "result"],
+)
+
+
+def _http_samples() -> List[str]:
+    requests, errors = {}, {}
+    for counter in request_counters():
+        for host, count in counter.by_host.items():
+            requests[host] = requests.get(host, 0) + count
+        for host, count in counter.errors_by_host.items():
+            errors[host] = errors.get(host, 0) + count
+    lines = []
+    for name, help, values in (
+        ("plexsync_http_requests_total", "HTTP responses received", requests),
+        (
+            "plexsync_http_errors_total",
+            "HTTP responses with an error status",
+            errors,
+        ),
+    ):
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+        lines += [
+            f"{name}{_labels(('host',), (host,))} {count}"
+            for host, count in sorted(values.items())
+        ]
+    return lines
+
+
+def record_target_cycle(target) -> None:
+    """Add the lookup statistics of a target at the end of a cycle.
+
+    Args:
+        target (Target): plex or jellyfin server prepared for the cycle
+    """
+    MEMO_LOOKUPS.inc(target.memo.hits, target=target.name, result="hit")
+    MEMO_LOOKUPS.inc(target.memo.misses, target=target.name, result="miss")
+    cache = target.cache
+    if cache is not None and cache.hits + cache.misses:
+        CACHE_LOOKUPS.inc(cache.hits, target=target.name, result="hit")
+        CACHE_LOOKUPS.inc(cache.misses, target=target.name, result="miss")
+        CACHE_HIT_RATIO.set(
+            cache.hits / (cache.hits + cache.misses), target=target.name
+        )
+
+
+def render() -> str:
+    """Return every metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    lines += _http_samples()
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # scrapes every few seconds would flood the sync logs
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serve the metrics at http://<host>:<port>/metrics in the background.
+
+    Args:
+        port (int): Port to listen on, on every interface
+
+    Returns:
+        ThreadingHTTPServer: the running server
+    """
+    server = ThreadingHTTPServer(("", port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving metrics on port %s", port)
+    return server
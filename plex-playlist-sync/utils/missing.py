@@ -0,0 +1,72 @@
+import csv
+import logging
+import pathlib
+import re
+import sys
+from typing import List, Optional
+
+from .helperClasses import Track
+from .store import SyncStore
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+_CSV_HEADER = ["title", "artist", "album", "url"]
+
+
+def _file_name(name: str) -> str:
+    """Turn a playlist or target name into a safe file name."""
+    return re.sub(r'[\x00-\x1f/\\:*?"<>|]', "_", name).strip(" .") or "_"
+
+
+def _write_csv(file: pathlib.Path, tracks: List[Track]) -> None:
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with open(file, "w", encoding="utf-8", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(_CSV_HEADER)
+        for track in tracks:
+            writer.writerow(
+                [track.title, track.artist, track.album, track.url]
+            )
+
+
+def export_missing_tracks(
+    store: SyncStore,
+    path: str,
+    target: Optional[str] = None,
+    playlist_id: Optional[str] = None,
+) -> int:
+    """Write the missing tracks of synced playlists as csv files.
+
+    Each target gets its own directory holding one ``<playlist>.csv`` per
+    playlist with missing tracks. The file of a playlist without missing
+    tracks is deleted. When every playlist of a target is exported, csv
+    files of playlists no longer synced are deleted as well.
+
+    Args:
+        store (SyncStore): Sync database holding the missing tracks
+        path (str): Root directory of the csv files
+        target (str, optional): Only export this target
+        playlist_id (str, optional): Only export this source playlist
+
+    Returns:
+        int: number of csv files written
+    """
+    written, kept = 0, {}
+    for target_name, name, tracks in store.missing_track_report(
+        target, playlist_id
+    ):
+        folder = pathlib.Path(path) / _file_name(target_name)
+        file = folder / f"{_file_name(name)}.csv"
+        kept.setdefault(folder, set())
+        if tracks:
+            _write_csv(file, tracks)
+            kept[folder].add(file)
+            written += 1
+        elif file.exists():
+            file.unlink()
+    if playlist_id is None:
+        for folder, files in kept.items():
+            for file in folder.glob("*.csv"):
+                if file not in files:
+                    file.unlink()
+    return written
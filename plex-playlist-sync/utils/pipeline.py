@@ -0,0 +1,121 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from queue import Full, Queue
+from typing import Callable, Iterable, Iterator, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
+def prefetch(items: Iterable[T], size: int = 2) -> Iterator[T]:
+    """Iterate over items produced by a background thread.
+
+    The producer runs at most ``size`` items ahead of the consumer, so a
+    source keeps downloading the next pages while the current one is
+    matched without ever holding the whole playlist. Errors raised by the
+    producer are raised again in the consumer.
+
+    Args:
+        items (Iterable): Items to produce, typically pages of tracks
+        size (int): Maximum number of items waiting in the queue
+
+    Yields:
+        items in order
+    """
+    queue = Queue(maxsize=max(size, 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+        else:
+            put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        # lets the producer exit when the consumer stops early
+        stop.set()
+
+
+def map_ahead(
+    function: Callable[..., T], args: Iterable, workers: int = 4
+) -> Iterator[T]:
+    """Like ``executor.map`` but with at most ``workers`` calls in flight.
+
+    Args:
+        function (Callable): Called with each argument
+        args (Iterable): Arguments, consumed as results are taken
+        workers (int): Calls running at once
+
+    Yields:
+        results in the order of ``args``
+    """
+    args = iter(args)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = deque(
+            executor.submit(function, arg) for arg in islice(args, workers)
+        )
+        while pending:
+            result = pending.popleft().result()
+            for arg in islice(args, 1):
+                pending.append(executor.submit(function, arg))
+            yield result
+
+
+def fetch_pages(
+    get_page: Callable[[int, int], Tuple[List[T], int]],
+    page_size: int,
+    workers: int = 4,
+) -> Iterator[List[T]]:
+    """Yield the items of every page of an offset paginated listing.
+
+    The first page tells the total, the remaining offsets are then
+    requested concurrently, at most ``workers`` pages ahead of the
+    consumer.
+
+    Args:
+        get_page (Callable): Returns the items at (limit, offset) and the
+            total number of items
+        page_size (int): Items per page, the maximum allowed by the endpoint
+        workers (int): Pages requested at once
+
+    Yields:
+        List: items of each page, in order
+    """
+    items, total = get_page(page_size, 0)
+    yield items
+    if items:
+        offsets = range(len(items), total, page_size)
+        for items, _ in map_ahead(
+            lambda offset: get_page(page_size, offset), offsets, workers
+        ):
+            yield items
@@ -1,113 +1,223 @@
-import csv
+import hashlib
 import logging
-import pathlib
 import sys
-from difflib import SequenceMatcher
-from typing import List
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 import plexapi
-from plexapi.exceptions import BadRequest, NotFound
+from plexapi.audio import Track as PlexTrack
+from plexapi.exceptions import NotFound
+from plexapi.library import MusicSection
 from plexapi.server import PlexServer
 
 from .helperClasses import Playlist, Track, UserInputs
+from .matching import LibraryIndex, resolve_tracks
+from .reconcile import plan_playlist_changes
+from .store import PlaylistMetadata, SyncStore
+from .target import IDS_PER_REQUEST, SyncTarget
+from .transport import request_counter
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 
-def _write_csv(tracks: List[Track], name: str, path: str = "/data") -> None:
-    """Write given tracks with given name as a csv.
+def _loaded(track: PlexTrack, attr: str) -> str:
+    """Read an attribute plex sent with the listing.
+
+    plexapi reloads a partially loaded object from the server whenever an
+    attribute it holds is None, e.g. a track without ``originalTitle``,
+    which would cost one request per track.
+    """
+    return track.__dict__.get(attr) or ""
+
+
+def _index_track(index: LibraryIndex, track: PlexTrack) -> None:
+    index.add(
+        str(track.ratingKey),
+        _loaded(track, "title"),
+        [_loaded(track, "grandparentTitle"), _loaded(track, "originalTitle")],
+        _loaded(track, "parentTitle"),
+        item=track,
+        duration=_loaded(track, "duration") or 0,
+    )
+
+
+def build_plex_library_index(
+    sections: List[MusicSection], page_size: int = 1000
+) -> LibraryIndex:
+    """Index every track in the given plex music sections.
+
+    Tracks are listed section by section in pages of ``page_size`` so the
+    number of requests depends on the library size only.
 
     Args:
-        tracks (List[Track]): List of Track objects
-        name (str): Name of the file to write
-        path (str): Root directory to write the file
+        sections (List[MusicSection]): plex music library sections
+        page_size (int): Number of tracks requested per page
+
+    Returns:
+        LibraryIndex: index of plex track objects
     """
-    # pathlib.Path(path).mkdir(parents=True, exist_ok=True)
-
-    data_folder = pathlib.Path(path)
-    data_folder.mkdir(parents=True, exist_ok=True)
-    file = data_folder / f"{name}.csv"
-
-    with open(file, "w", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(Track.__annotations__.keys())
-        for track in tracks:
-            writer.writerow(
-                [track.title, track.artist, track.album, track.url]
-            )
+    start = time.monotonic()
+    index = LibraryIndex()
+    for section in sections:
+        for track in section.searchTracks(container_size=page_size):
+            _index_track(index, track)
+    logging.info(
+        "Indexed %s plex tracks in %.1fs",
+        index.size,
+        time.monotonic() - start,
+    )
+    return index
+
+
+def _music_sections(server: PlexServer) -> List[MusicSection]:
+    return [s for s in server.library.sections() if s.type == "artist"]
 
 
-def _delete_csv(name: str, path: str = "/data") -> None:
-    """Delete file associated with given name
+def _sections_generation(sections: List[MusicSection]) -> str:
+    return ",".join(f"{s.key}:{s.updatedAt}" for s in sections)
+
+
+def plex_library_generation(server: PlexServer) -> str:
+    """Return a value that changes whenever a music section is rescanned.
 
     Args:
-        name (str): Name of the file to delete
-        path (str, optional): Root directory to delete the file from
+        server (PlexServer): A configured PlexServer instance
+
+    Returns:
+        str: generation of the music sections, a single request
+    """
+    return _sections_generation(_music_sections(server))
+
+
+class PlexTarget(SyncTarget):
+    """A plex server together with the state built for the current cycle.
+
+    Attributes:
+        generation (str): Changes whenever a music section is rescanned
     """
-    data_folder = pathlib.Path(path)
-    file = data_folder / f"{name}.csv"
-    file.unlink()
 
+    def __init__(
+        self,
+        server: PlexServer,
+        userInputs: UserInputs,
+        store: Optional[SyncStore] = None,
+    ) -> None:
+        super().__init__(f"plex:{server.machineIdentifier}", userInputs, store)
+        self.server = server
+        self.requests = request_counter(server._session)
+        self.sections = _music_sections(server)
+        self.generation = _sections_generation(self.sections)
+        self._page_size = userInputs.plex_index_page_size
+
+    def _build_index(self) -> LibraryIndex:
+        return build_plex_library_index(self.sections, self._page_size)
 
-def _get_available_plex_tracks(plex: PlexServer, tracks: List[Track]) -> List:
-    """Search and return list of tracks available in plex.
+    def tracks(self, keys: List[str]) -> Dict[str, PlexTrack]:
+        """Return the plex tracks still in the library for the given keys.
+
+        Answered from the index once it is built, otherwise the keys are
+        looked up directly, one request per 100 keys, so validating cached
+        matches never lists the whole library.
+
+        Args:
+            keys (List[str]): plex rating keys
+
+        Returns:
+            Dict[str, PlexTrack]: rating key to plex track object
+        """
+        index = self._built_index()
+        if index is not None:
+            return {key: index.get(key) for key in keys if key in index}
+        found = {}
+        for start in range(0, len(keys), IDS_PER_REQUEST):
+            page = ",".join(keys[start : start + IDS_PER_REQUEST])
+            try:
+                items = self.server.fetchItems(f"/library/metadata/{page}")
+            except NotFound:
+                # plex answers 404 when none of the keys exist anymore
+                continue
+            for item in items:
+                if isinstance(item, PlexTrack):
+                    found[str(item.ratingKey)] = item
+        return found
+
+    def recently_added(self, since: float) -> LibraryIndex:
+        """Index the tracks added to the music sections since a time.
+
+        Args:
+            since (float): unix time
+
+        Returns:
+            LibraryIndex: index of the new plex track objects
+        """
+        index = LibraryIndex()
+        added = {"addedAt>>": datetime.fromtimestamp(since)}
+        for section in self.sections:
+            for track in section.searchTracks(
+                filters=added, container_size=self._page_size
+            ):
+                _index_track(index, track)
+        return index
+
+    def match(
+        self, tracks: List[Track]
+    ) -> Tuple[List, List[Track], List[Track]]:
+        """Resolve tracks to plex track objects.
+
+        Args:
+            tracks (List[Track]): list of track objects
+
+        Returns:
+            Tuple[List, List[Track], List[Track]]: plex track objects,
+            missing tracks and tracks whose matching failed
+        """
+        return _get_available_plex_tracks(self, tracks)
+
+
+def _get_available_plex_tracks(
+    plex: PlexTarget, tracks: List[Track]
+) -> Tuple[List, List[Track], List[Track]]:
+    """Resolve tracks against the match cache and plex library index.
+
+    The library index is only built once a track is not in the cache,
+    cached keys are looked up directly.
 
     Args:
-        plex (PlexServer): A configured PlexServer instance
+        plex (PlexTarget): plex server prepared for the cycle
         tracks (List[Track]): list of track objects
 
     Returns:
-        List: of plex track objects
+        Tuple[List, List[Track], List[Track]]: plex track objects, missing
+        tracks and tracks whose matching failed
     """
-    plex_tracks, missing_tracks = [], []
-    for track in tracks:
-        search = []
-        try:
-            search = plex.search(track.title, mediatype="track", limit=5)
-        except BadRequest:
-            logging.info("failed to search %s on plex", track.title)
-        if (not search) or len(track.title.split("(")) > 1:
-            logging.info("retrying search for %s", track.title)
-            try:
-                search += plex.search(
-                    track.title.split("(")[0], mediatype="track", limit=5
-                )
-                logging.info("search for %s successful", track.title)
-            except BadRequest:
-                logging.info("unable to query %s on plex", track.title)
-
-        found = False
-        if search:
-            for s in search:
-                try:
-                    artist_similarity = SequenceMatcher(
-                        None, s.artist().title.lower(), track.artist.lower()
-                    ).quick_ratio()
-
-                    if artist_similarity >= 0.9:
-                        plex_tracks.extend(s)
-                        found = True
-                        break
-
-                    album_similarity = SequenceMatcher(
-                        None, s.album().title.lower(), track.album.lower()
-                    ).quick_ratio()
-
-                    if album_similarity >= 0.9:
-                        plex_tracks.extend(s)
-                        found = True
-                        break
-
-                except IndexError:
-                    logging.info(
-                        "Looks like plex mismatched the search for %s,"
-                        " retrying with next result",
-                        track.title,
-                    )
-        if not found:
-            missing_tracks.append(track)
-
-    return plex_tracks, missing_tracks
+    found = {}
+
+    def existing(keys: List[str]) -> Dict[str, PlexTrack]:
+        found.update(plex.tracks(keys))
+        return found
+
+    with plex.requests.measure() as requests:
+        keys, missing_tracks, failed_tracks = resolve_tracks(
+            tracks,
+            plex.memo.memoize(lambda track: plex.index.match(track)),
+            plex.cache,
+            existing,
+            # listed once per page, not once per track when it fails
+            prepare=lambda: plex.index,
+        )
+    if requests.count:
+        logging.info(
+            "Matching %s tracks sent %s requests to plex",
+            len(tracks),
+            requests.count,
+        )
+    if plex.cache is not None:
+        plex.cache.flush()
+    # keys that are not cached were matched, so the index is built
+    return [
+        found[key] if key in found else plex.index.get(key) for key in keys
+    ], missing_tracks, failed_tracks
 
 
 def _update_plex_playlist(
@@ -118,6 +228,9 @@ def _update_plex_playlist(
 ) -> plexapi.playlist.Playlist:
     """Update existing plex playlist with new tracks and metadata.
 
+    Only the necessary removes, adds and moves are sent, nothing is written
+    when the playlist already holds the tracks in order.
+
     Args:
         plex (PlexServer): A configured PlexServer instance
         available_tracks (List): list of plex track objects
@@ -128,57 +241,155 @@ def _update_plex_playlist(
         plexapi.playlist.Playlist: plex playlist object
     """
     plex_playlist = plex.playlist(playlist.name)
-    if not append:
-        plex_playlist.removeItems(plex_playlist.items())
-    plex_playlist.addItems(available_tracks)
+    items = plex_playlist.items()
+    changes = plan_playlist_changes(
+        [str(item.ratingKey) for item in items],
+        [str(track.ratingKey) for track in available_tracks],
+        append,
+    )
+    if not changes:
+        logging.info("Playlist %s is already up to date", playlist.name)
+        return plex_playlist
+
+    # Entries are edited by playlistItemID, the plexapi helpers look every
+    # item up again and can't tell duplicate entries apart
+    for pos in changes.remove:
+        plex.query(
+            f"{plex_playlist.key}/items/{items[pos].playlistItemID}",
+            method=plex._session.delete,
+        )
+    if changes.add:
+        tracks = {str(track.ratingKey): track for track in available_tracks}
+        plex_playlist.addItems([tracks[key] for key in changes.add])
+    if changes.moves:
+        entry_ids = {
+            str(item.ratingKey): item.playlistItemID
+            for item in plex_playlist.fetchItems(f"{plex_playlist.key}/items")
+        }
+        for key, after in changes.moves:
+            move = f"{plex_playlist.key}/items/{entry_ids[key]}/move"
+            if after is not None:
+                move += f"?after={entry_ids[after]}"
+            plex.query(move, method=plex._session.put)
+    logging.info(
+        "Playlist %s: removed %s, added %s, moved %s tracks",
+        playlist.name,
+        len(changes.remove),
+        len(changes.add),
+        len(changes.moves),
+    )
     return plex_playlist
 
 
-def update_or_create_plex_playlist(
-    plex: PlexServer,
+def _fingerprint(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def _poster_hash(plex: PlexTarget, url: str) -> str:
+    """Download a poster and return its hash, "" if the download failed."""
+    try:
+        response = plex.server._session.get(url, timeout=30)
+        response.raise_for_status()
+    except Exception as e:
+        logging.info("Failed to download poster %s: %s", url, e)
+        return ""
+    return _fingerprint(response.content)
+
+
+def _update_plex_metadata(
+    plex: PlexTarget,
+    plex_playlist: plexapi.playlist.Playlist,
     playlist: Playlist,
-    tracks: List[Track],
     userInputs: UserInputs,
+    created: bool = False,
 ) -> None:
-    """Update playlist if exists, else create a new playlist.
+    """Write the summary and poster of a playlist when they changed.
+
+    Fingerprints of the values last written are kept in the sync database.
+    A poster with a new URL is downloaded first and only uploaded when the
+    image differs, plex fetches and transcodes the image on every upload.
 
     Args:
-        plex (PlexServer): A configured PlexServer instance
-        available_tracks (List): List of plex.audio.track objects
+        plex (PlexTarget): plex server prepared for the cycle
+        plex_playlist (plexapi.playlist.Playlist): playlist on plex
         playlist (Playlist): Playlist object
+        userInputs (UserInputs): user configuration
+        created (bool): The playlist was just created and has no metadata
     """
-    available_tracks, missing_tracks = _get_available_plex_tracks(plex, tracks)
-    if available_tracks:
-        try:
-            plex_playlist = _update_plex_playlist(
-                plex=plex,
-                available_tracks=available_tracks,
-                playlist=playlist,
-                append=userInputs.append_instead_of_sync,
-            )
-            logging.info("Updated playlist %s", playlist.name)
-        except NotFound:
-            plex.createPlaylist(title=playlist.name, items=available_tracks)
-            logging.info("Created playlist %s", playlist.name)
-            plex_playlist = plex.playlist(playlist.name)
+    saved = None
+    if plex.store is not None and not created:
+        saved = plex.store.playlist_metadata(plex.name, playlist.id)
+    written = PlaylistMetadata(**vars(saved)) if saved else PlaylistMetadata()
 
-        if playlist.description and userInputs.add_playlist_description:
+    if playlist.description and userInputs.add_playlist_description:
+        description = _fingerprint(playlist.description.encode())
+        if description != written.description:
             try:
                 plex_playlist.edit(summary=playlist.description)
+                written.description = description
+                logging.info("Updated description of %s", playlist.name)
             except:
                 logging.info(
                     "Failed to update description for playlist %s",
                     playlist.name,
                 )
-        if playlist.poster and userInputs.add_playlist_poster:
+    if (
+        playlist.poster
+        and userInputs.add_playlist_poster
+        and playlist.poster != written.poster_url
+    ):
+        poster_hash = _poster_hash(plex, playlist.poster)
+        if poster_hash and poster_hash == written.poster_hash:
+            written.poster_url = playlist.poster
+        else:
             try:
                 plex_playlist.uploadPoster(url=playlist.poster)
+                written.poster_url = playlist.poster
+                written.poster_hash = poster_hash
+                logging.info("Updated poster of %s", playlist.name)
             except:
                 logging.info(
                     "Failed to update poster for playlist %s", playlist.name
                 )
-        logging.info(
-            "Updated playlist %s with summary and poster", playlist.name
+    if plex.store is not None and written != saved:
+        plex.store.save_playlist_metadata(plex.name, playlist.id, written)
+
+
+def update_or_create_plex_playlist(
+    plex: PlexTarget,
+    playlist: Playlist,
+    available_tracks: List,
+    missing_tracks: List[Track],
+    userInputs: UserInputs,
+) -> None:
+    """Update playlist if exists, else create a new playlist.
+
+    Args:
+        plex (PlexTarget): plex server prepared for the cycle
+        playlist (Playlist): Playlist object
+        available_tracks (List): plex track objects, see PlexTarget.match
+        missing_tracks (List[Track]): tracks that were not found on plex
+        userInputs (UserInputs): user configuration
+    """
+    if available_tracks:
+        try:
+            plex_playlist = _update_plex_playlist(
+                plex=plex.server,
+                available_tracks=available_tracks,
+                playlist=playlist,
+                append=userInputs.append_instead_of_sync,
+            )
+            logging.info("Updated playlist %s", playlist.name)
+            created = False
+        except NotFound:
+            plex.server.createPlaylist(
+                title=playlist.name, items=available_tracks
+            )
+            logging.info("Created playlist %s", playlist.name)
+            plex_playlist = plex.server.playlist(playlist.name)
+            created = True
+        _update_plex_metadata(
+            plex, plex_playlist, playlist, userInputs, created
         )
 
     else:
@@ -187,23 +398,3 @@ def update_or_create_plex_playlist(
             " playlist creation",
             playlist.name,
         )
-    if missing_tracks and userInputs.write_missing_as_csv:
-        try:
-            _write_csv(missing_tracks, playlist.name)
-            logging.info("Missing tracks written to %s.csv", playlist.name)
-        except:
-            logging.info(
-                "Failed to write missing tracks for %s, likely permission"
-                " issue",
-                playlist.name,
-            )
-    if (not missing_tracks) and userInputs.write_missing_as_csv:
-        try:
-            # Delete playlist created in prev run if no tracks are missing now
-            _delete_csv(playlist.name)
-            logging.info("Deleted old %s.csv", playlist.name)
-        except:
-            logging.info(
-                "Failed to delete %s.csv, likely permission issue",
-                playlist.name,
-            )
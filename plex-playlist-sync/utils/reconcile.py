@@ -0,0 +1,84 @@
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Set, Tuple
+
+
+@dataclass
+class PlaylistChanges:
+    """Edits turning the current playlist entries into the desired ones.
+
+    Apply ``remove`` first, then append ``add`` and finally run ``moves``
+    in order.
+    """
+
+    # positions in the current entries to delete
+    remove: List[int] = field(default_factory=list)
+    # keys to append at the end of the playlist
+    add: List[str] = field(default_factory=list)
+    # (key, key it goes after or None for the first position)
+    moves: List[Tuple[str, Optional[str]]] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.remove or self.add or self.moves)
+
+
+def _longest_increasing_run(values: Sequence[int]) -> Set[int]:
+    """Return the values of a longest strictly increasing subsequence."""
+    tails, tail_pos, previous = [], [], [-1] * len(values)
+    for i, value in enumerate(values):
+        j = bisect_left(tails, value)
+        if j == len(tails):
+            tails.append(value)
+            tail_pos.append(i)
+        else:
+            tails[j] = value
+            tail_pos[j] = i
+        previous[i] = tail_pos[j - 1] if j else -1
+    run, i = set(), tail_pos[-1] if tail_pos else -1
+    while i != -1:
+        run.add(values[i])
+        i = previous[i]
+    return run
+
+
+def plan_playlist_changes(
+    current: Sequence[str], desired: Sequence[str], append: bool = False
+) -> PlaylistChanges:
+    """Compute the minimal edits to sync a playlist.
+
+    Entries that already sit in the right relative order are left alone,
+    only the ones outside the longest in-order run are moved.
+
+    Args:
+        current (Sequence[str]): Item keys currently in the playlist
+        desired (Sequence[str]): Item keys wanted, in order
+        append (bool): Only add missing keys, never remove or reorder
+
+    Returns:
+        PlaylistChanges: edits to apply, falsy when nothing changed
+    """
+    desired = list(dict.fromkeys(desired))
+    changes = PlaylistChanges()
+    if append:
+        present = set(current)
+        changes.add = [key for key in desired if key not in present]
+        return changes
+
+    wanted = set(desired)
+    kept, seen = [], set()
+    for pos, key in enumerate(current):
+        if key in wanted and key not in seen:
+            kept.append(key)
+            seen.add(key)
+        else:
+            changes.remove.append(pos)
+    changes.add = [key for key in desired if key not in seen]
+
+    position = {key: i for i, key in enumerate(desired)}
+    in_order = _longest_increasing_run(
+        [position[key] for key in kept + changes.add]
+    )
+    for i, key in enumerate(desired):
+        if i not in in_order:
+            changes.moves.append((key, desired[i - 1] if i else None))
+    return changes
@@ -0,0 +1,144 @@
+import logging
+import random
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Set
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+
+class Scheduler:
+    """Runs each source at its own interval.
+
+    Every run is followed by the interval of its source, stretched or
+    shortened by up to ``jitter`` of it so sources don't keep hitting the
+    servers at the same moment. Every source is due at start.
+    """
+
+    def __init__(self, intervals: Dict[str, int], jitter: float = 0.1) -> None:
+        self._intervals = intervals
+        self._jitter = jitter
+        now = time.monotonic()
+        self._next = {name: now for name in intervals}
+
+    def due(self) -> List[str]:
+        """Return the sources to run now and schedule their next run.
+
+        Returns:
+            List[str]: names of the due sources
+        """
+        now = time.monotonic()
+        due = [name for name, at in self._next.items() if at <= now]
+        for name in due:
+            interval = self._intervals[name]
+            self._next[name] = now + interval * random.uniform(
+                1 - self._jitter, 1 + self._jitter
+            )
+        return due
+
+    def seconds_until_due(self) -> float:
+        return max(0.0, min(self._next.values()) - time.monotonic())
+
+
+class LibraryWatcher:
+    """Tells which target libraries gained or lost items.
+
+    Targets are polled every ``poll_seconds`` through their generation
+    function, a cheap request returning a value that changes with the
+    library. :meth:`notify` asks for a poll right away, for servers that
+    report their scans.
+    """
+
+    def __init__(self, poll_seconds: int) -> None:
+        self._poll_seconds = poll_seconds
+        self._generations = {}
+        self._watched = {}
+        self._changed = set()
+        self._poll_now = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._next_poll = time.monotonic() + poll_seconds
+
+    def watch(
+        self, name: str, generation: str, get_generation: Callable[[], str]
+    ) -> None:
+        """Start watching a target, or record that it was just synced.
+
+        Args:
+            name (str): Target name
+            generation (str): Generation the target was synced at
+            get_generation (Callable): Returns the current generation
+        """
+        with self._lock:
+            self._generations[name] = generation
+            self._watched[name] = get_generation
+            self._changed.discard(name)
+
+    def notify(self) -> None:
+        """Poll the targets as soon as possible."""
+        with self._lock:
+            self._poll_now = True
+        self._wake.set()
+
+    def _poll(self) -> None:
+        with self._lock:
+            watched = dict(self._watched)
+        for name, get_generation in watched.items():
+            try:
+                generation = get_generation()
+            except Exception as e:
+                logging.info("Failed to check the library of %s: %s", name, e)
+                continue
+            with self._lock:
+                if generation != self._generations.get(name):
+                    logging.info("Library of %s changed", name)
+                    self._generations[name] = generation
+                    self._changed.add(name)
+
+    def wait(self, timeout: float) -> Set[str]:
+        """Wait until a target library changed or the timeout expired.
+
+        Args:
+            timeout (float): Seconds to wait at most
+
+        Returns:
+            Set[str]: names of the changed targets, empty on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                poll, self._poll_now = self._poll_now, False
+            if self._poll_seconds and now >= self._next_poll:
+                poll = True
+                self._next_poll = now + self._poll_seconds
+            if poll:
+                self._poll()
+            with self._lock:
+                if self._changed:
+                    changed, self._changed = self._changed, set()
+                    return changed
+            if now >= deadline:
+                return set()
+            wake_at = deadline
+            if self._poll_seconds:
+                wake_at = min(wake_at, self._next_poll)
+            self._wake.wait(max(0.0, wake_at - now))
+            self._wake.clear()
+
+
+def plex_scan_finished(data: dict) -> bool:
+    """Check if a plex alert reports the end of a library scan.
+
+    Args:
+        data (dict): NotificationContainer of a plex websocket message
+
+    Returns:
+        bool: True when a section finished updating
+    """
+    return data.get("type") == "activity" and any(
+        n.get("event") == "ended"
+        and n.get("Activity", {}).get("type") == "library.update.section"
+        for n in data.get("ActivityNotification", [])
+    )
@@ -1,15 +1,29 @@
 import logging
-from typing import List
+from itertools import chain
+from typing import Iterator, List, Optional, Set, Tuple
 
 import spotipy
-from plexapi.server import PlexServer
 
 from .helperClasses import Playlist, Track, UserInputs
-from .plex import update_or_create_plex_playlist
-from .jellyfin import update_or_create_jellyfin_playlist
+from .pipeline import fetch_pages
+from .sync import Target, select_playlists, sync_playlist
+
+# only the track fields used for matching are sent back
+_TRACK_FIELDS = (
+    "total,items(track(id,name,duration_ms,artists(name),album(name),"
+    "external_ids(isrc)))"
+)
+
+
+def _page(response: dict) -> Tuple[List[dict], int]:
+    return response["items"], response["total"]
+
 
 def _get_sp_user_playlists(
-    sp: spotipy.Spotify, user_id: str, suffix: str = " - Spotify"
+    sp: spotipy.Spotify,
+    user_id: str,
+    suffix: str = " - Spotify",
+    workers: int = 4,
 ) -> List[Playlist]:
     """Get metadata for playlists in the given user_id.
 
@@ -17,14 +31,23 @@ def _get_sp_user_playlists(
         sp (spotipy.Spotify): Spotify configured instance
         userId (str): UserId of the spotify account (get it from open.spotify.com/account)
         suffix (str): Identifier for source
+        workers (int): Pages requested at once
     Returns:
         List[Playlist]: list of Playlist objects with playlist metadata fields
     """
     playlists = []
 
     try:
-        sp_playlists = sp.user_playlists(user_id)
-        for playlist in sp_playlists["items"]:
+        sp_playlists = chain.from_iterable(
+            fetch_pages(
+                lambda limit, offset: _page(
+                    sp.user_playlists(user_id, limit=limit, offset=offset)
+                ),
+                50,
+                workers,
+            )
+        )
+        for playlist in sp_playlists:
             playlists.append(
                 Playlist(
                     id=playlist["uri"],
@@ -32,8 +55,9 @@ def _get_sp_user_playlists(
                     description=playlist.get("description", ""),
                     # playlists may not have a poster in such cases return ""
                     poster=""
-                    if len(playlist["images"]) == 0
+                    if not playlist.get("images")
                     else playlist["images"][0].get("url", ""),
+                    change_token=playlist.get("snapshot_id", ""),
                 )
             )
     except:
@@ -42,16 +66,16 @@ def _get_sp_user_playlists(
 
 
 def _get_sp_tracks_from_playlist(
-    sp: spotipy.Spotify, user_id: str, playlist: Playlist
-) -> List[Track]:
-    """Return list of tracks with metadata.
+    sp: spotipy.Spotify, playlist: Playlist, workers: int = 4
+) -> Iterator[List[Track]]:
+    """Yield the tracks of a playlist with metadata, one page at a time.
 
     Args:
         sp (spotipy.Spotify): Spotify configured instance
-        user_id (str): spotify user id
         playlist (Playlist): Playlist object
-    Returns:
-        List[Track]: list of Track objects with track metadata fields
+        workers (int): Pages requested at once
+    Yields:
+        List[Track]: Track objects with track metadata fields of a page
     """
 
     def extract_sp_track_metadata(track) -> Track:
@@ -60,55 +84,63 @@ def _get_sp_tracks_from_playlist(
         album = track["track"]["album"]["name"]
         # Tracks may no longer be on spotify in such cases return ""
         url = track["track"]["id"]
-        return Track(title, artist, album, url)
-
-    sp_playlist_tracks = sp.user_playlist_tracks(user_id, playlist.id)
-
-    # Only processes first 100 tracks
-    tracks = list(
-        map(
-            extract_sp_track_metadata,
-            [i for i in sp_playlist_tracks["items"] if i.get("track")],
+        return Track(
+            title,
+            artist,
+            album,
+            url,
+            isrc=(track["track"].get("external_ids") or {}).get("isrc", ""),
+            duration=track["track"].get("duration_ms") or 0,
+            provider_ids={"spotify": url} if url else {},
         )
-    )
 
-    # If playlist contains more than 100 tracks this loop is useful
-    while sp_playlist_tracks["next"]:
-        sp_playlist_tracks = sp.next(sp_playlist_tracks)
-        tracks.extend(
-            list(
-                map(
-                    extract_sp_track_metadata,
-                    [i for i in sp_playlist_tracks["items"] if i.get("track")],
-                )
+    pages = fetch_pages(
+        lambda limit, offset: _page(
+            sp.playlist_items(
+                playlist.id,
+                fields=_TRACK_FIELDS,
+                limit=limit,
+                offset=offset,
+                additional_types=("track",),
             )
-        )
-    return tracks
+        ),
+        100,
+        workers,
+    )
+    for items in pages:
+        yield [extract_sp_track_metadata(i) for i in items if i.get("track")]
 
 
 def spotify_playlist_sync(
-    sp: spotipy.Spotify, plex: PlexServer, jellyfin, userInputs: UserInputs
+    sp: spotipy.Spotify,
+    targets: List[Target],
+    userInputs: UserInputs,
+    playlist_ids: Optional[Set[str]] = None,
 ) -> None:
     """Create/Update plex playlists with playlists from spotify.
 
     Args:
         sp (spotipy.Spotify): Spotify configured instance
-        user_id (str): spotify user id
-        plex (PlexServer): A configured PlexServer instance
+        targets (List[Target]): plex and jellyfin servers prepared for the
+            cycle
+        playlist_ids (Set[str], optional): Only sync these playlists
     """
     playlists = _get_sp_user_playlists(
         sp,
         userInputs.spotify_user_id,
         " - Spotify" if userInputs.append_service_suffix else "",
+        userInputs.fetch_concurrency,
     )
     if playlists:
-        for playlist in playlists:
-            tracks = _get_sp_tracks_from_playlist(
-                sp, userInputs.spotify_user_id, playlist
+        for playlist in select_playlists(playlists, playlist_ids):
+            sync_playlist(
+                playlist,
+                lambda p: _get_sp_tracks_from_playlist(
+                    sp, p, userInputs.fetch_concurrency
+                ),
+                targets,
+                userInputs,
+                "spotify",
             )
-            if plex is not None:
-                update_or_create_plex_playlist(plex, playlist, tracks, userInputs)
-            if jellyfin is not None:
-                update_or_create_jellyfin_playlist(jellyfin, playlist, tracks, userInputs)
     else:
         logging.error("No spotify playlists found for given user")
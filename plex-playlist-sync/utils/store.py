@@ -0,0 +1,479 @@
+import logging
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
+
+from .helperClasses import Track
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS match_cache (
+    target TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    item_key TEXT,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (target, source_id)
+);
+CREATE TABLE IF NOT EXISTS playlist_state (
+    target TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    token TEXT NOT NULL,
+    generation TEXT NOT NULL,
+    missing INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (target, playlist_id)
+);
+CREATE TABLE IF NOT EXISTS missing_track (
+    target TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    album TEXT NOT NULL,
+    PRIMARY KEY (target, playlist_id, source_id)
+);
+CREATE TABLE IF NOT EXISTS playlist_metadata (
+    target TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    description TEXT NOT NULL,
+    poster_url TEXT NOT NULL,
+    poster_hash TEXT NOT NULL,
+    PRIMARY KEY (target, playlist_id)
+);
+CREATE TABLE IF NOT EXISTS recheck_state (
+    target TEXT PRIMARY KEY,
+    checked_at REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class PlaylistState:
+    """How a source playlist was last written to a target."""
+
+    name: str
+    token: str
+    generation: str
+    missing: int
+    # set when read from the store
+    synced_at: float = 0.0
+
+
+@dataclass
+class PlaylistMetadata:
+    """Fingerprints of the metadata last written to a target playlist."""
+
+    # hash of the description, "" if never written
+    description: str = ""
+    poster_url: str = ""
+    # hash of the poster image, "" if it could not be downloaded
+    poster_hash: str = ""
+
+
+def _source_id(track: Track) -> str:
+    return track.url or f"{track.title}|{track.artist}"
+
+
+class SyncStore:
+    """SQLite database keeping sync state between cycles."""
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def load_matches(
+        self, target: str
+    ) -> Dict[str, Tuple[Optional[str], float]]:
+        """Return every cached match of a target.
+
+        Args:
+            target (str): Target name
+
+        Returns:
+            Dict: source id to (server key or None, time of the match)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source_id, item_key, checked_at FROM match_cache"
+                " WHERE target = ?",
+                (target,),
+            ).fetchall()
+        return {source_id: (key, at) for source_id, key, at in rows}
+
+    def save_matches(
+        self,
+        target: str,
+        matches: Iterable[Tuple[str, Optional[str], float]],
+        deleted: Iterable[str] = (),
+    ) -> None:
+        """Write changed matches of a target in a single transaction.
+
+        Args:
+            target (str): Target name
+            matches (Iterable): (source id, server key or None, time) rows
+            deleted (Iterable[str]): Source ids to forget
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM match_cache WHERE target = ? AND source_id = ?",
+                [(target, source_id) for source_id in deleted],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO match_cache VALUES (?, ?, ?, ?)",
+                [(target, *row) for row in matches],
+            )
+
+    def playlist_state(
+        self, target: str, playlist_id: str
+    ) -> Optional[PlaylistState]:
+        """Return the last recorded sync of a playlist to a target.
+
+        Args:
+            target (str): Target name
+            playlist_id (str): Source playlist id
+
+        Returns:
+            Optional[PlaylistState]: state, None if never synced
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, token, generation, missing, synced_at"
+                " FROM playlist_state"
+                " WHERE target = ? AND playlist_id = ?",
+                (target, str(playlist_id)),
+            ).fetchone()
+        return PlaylistState(*row) if row is not None else None
+
+    def save_playlist_state(
+        self, target: str, playlist_id: str, state: PlaylistState
+    ) -> None:
+        """Record a successful sync of a playlist to a target.
+
+        Args:
+            target (str): Target name
+            playlist_id (str): Source playlist id
+            state (PlaylistState): Synced playlist state
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO playlist_state"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    target,
+                    str(playlist_id),
+                    state.name,
+                    state.token,
+                    state.generation,
+                    state.missing,
+                    time.time(),
+                ),
+            )
+
+    def playlist_metadata(
+        self, target: str, playlist_id: str
+    ) -> Optional[PlaylistMetadata]:
+        """Return the metadata last written to a playlist of a target.
+
+        Args:
+            target (str): Target name
+            playlist_id (str): Source playlist id
+
+        Returns:
+            Optional[PlaylistMetadata]: fingerprints, None if never written
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT description, poster_url, poster_hash"
+                " FROM playlist_metadata"
+                " WHERE target = ? AND playlist_id = ?",
+                (target, str(playlist_id)),
+            ).fetchone()
+        return PlaylistMetadata(*row) if row is not None else None
+
+    def save_playlist_metadata(
+        self, target: str, playlist_id: str, metadata: PlaylistMetadata
+    ) -> None:
+        """Record the metadata written to a playlist of a target.
+
+        Args:
+            target (str): Target name
+            playlist_id (str): Source playlist id
+            metadata (PlaylistMetadata): Fingerprints of the written values
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO playlist_metadata"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    target,
+                    str(playlist_id),
+                    metadata.description,
+                    metadata.poster_url,
+                    metadata.poster_hash,
+                ),
+            )
+
+    def mark_playlists_stale(
+        self, target: str, playlist_ids: Iterable[str]
+    ) -> None:
+        """Make the next sync of the given playlists write them again.
+
+        Args:
+            target (str): Target name
+            playlist_ids (Iterable[str]): Source playlist ids
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE playlist_state SET token = '', synced_at = 0"
+                " WHERE target = ? AND playlist_id = ?",
+                [(target, str(playlist_id)) for playlist_id in playlist_ids],
+            )
+
+    def save_missing_tracks(
+        self, target: str, playlist_id: str, tracks: List[Track]
+    ) -> bool:
+        """Record the tracks of a playlist that were not found on a target.
+
+        Only the tracks that were found since, or went missing since, the
+        previous sync are written.
+
+        Args:
+            target (str): Target name
+            playlist_id (str): Source playlist id
+            tracks (List[Track]): Missing tracks, replacing the previous ones
+
+        Returns:
+            bool: True if the missing tracks changed
+        """
+        missing = {_source_id(track): track for track in tracks}
+        with self._lock, self._conn:
+            known = {
+                source_id
+                for source_id, in self._conn.execute(
+                    "SELECT source_id FROM missing_track"
+                    " WHERE target = ? AND playlist_id = ?",
+                    (target, str(playlist_id)),
+                )
+            }
+            found = known - missing.keys()
+            added = [key for key in missing if key not in known]
+            self._conn.executemany(
+                "DELETE FROM missing_track WHERE target = ?"
+                " AND playlist_id = ? AND source_id = ?",
+                [(target, str(playlist_id), key) for key in found],
+            )
+            self._conn.executemany(
+                "INSERT INTO missing_track VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        target,
+                        str(playlist_id),
+                        key,
+                        missing[key].title or "",
+                        missing[key].artist or "",
+                        missing[key].album or "",
+                    )
+                    for key in added
+                ],
+            )
+        return bool(found or added)
+
+    def missing_tracks(self, target: str) -> Dict[str, List[Track]]:
+        """Return the missing tracks of every playlist synced to a target.
+
+        Args:
+            target (str): Target name
+
+        Returns:
+            Dict[str, List[Track]]: source playlist id to missing tracks
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT playlist_id, source_id, title, artist, album"
+                " FROM missing_track WHERE target = ?",
+                (target,),
+            ).fetchall()
+        missing = {}
+        for playlist_id, source_id, title, artist, album in rows:
+            missing.setdefault(playlist_id, []).append(
+                Track(title, artist, album, source_id)
+            )
+        return missing
+
+    def missing_track_report(
+        self, target: Optional[str] = None, playlist_id: Optional[str] = None
+    ) -> List[Tuple[str, str, List[Track]]]:
+        """Return the missing tracks of synced playlists with their names.
+
+        Playlists without missing tracks are included with an empty list.
+
+        Args:
+            target (str, optional): Only this target
+            playlist_id (str, optional): Only this source playlist
+
+        Returns:
+            List[Tuple[str, str, List[Track]]]: (target, playlist name,
+            missing tracks) of each playlist synced to a target
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.target, s.playlist_id, s.name, m.source_id,"
+                " m.title, m.artist, m.album FROM playlist_state s"
+                " LEFT JOIN missing_track m ON m.target = s.target"
+                " AND m.playlist_id = s.playlist_id"
+                " WHERE (?1 IS NULL OR s.target = ?1)"
+                " AND (?2 IS NULL OR s.playlist_id = ?2)"
+                " ORDER BY s.target, s.name, m.rowid",
+                (target, None if playlist_id is None else str(playlist_id)),
+            ).fetchall()
+        report = {}
+        for target, playlist_id, name, source_id, *fields in rows:
+            entry = report.setdefault((target, playlist_id), (target, name, []))
+            if source_id is not None:
+                entry[2].append(Track(*fields, source_id))
+        return list(report.values())
+
+    def recheck_time(self, target: str) -> Optional[float]:
+        """Return when missing tracks of a target were last rechecked.
+
+        Args:
+            target (str): Target name
+
+        Returns:
+            Optional[float]: unix time, None if never rechecked
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT checked_at FROM recheck_state WHERE target = ?",
+                (target,),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def save_recheck_time(self, target: str, checked_at: float) -> None:
+        """Record when missing tracks of a target were rechecked.
+
+        Args:
+            target (str): Target name
+            checked_at (float): unix time the recheck started
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO recheck_state VALUES (?, ?)",
+                (target, checked_at),
+            )
+
+
+def open_store(data_dir: str) -> Optional[SyncStore]:
+    """Open the sync database in the given directory.
+
+    Args:
+        data_dir (str): Directory holding persistent data
+
+    Returns:
+        Optional[SyncStore]: store, None if the directory is not writable
+    """
+    try:
+        data_folder = pathlib.Path(data_dir)
+        data_folder.mkdir(parents=True, exist_ok=True)
+        return SyncStore(str(data_folder / "plex-playlist-sync.db"))
+    except (OSError, sqlite3.Error):
+        logging.info(
+            "Unable to open sync database in %s, matches won't be cached"
+            " and every playlist will be synced",
+            data_dir,
+        )
+        return None
+
+
+class MatchCache(MutableMapping):
+    """Source track id to server key mapping of one target.
+
+    Loaded once per cycle, a ``None`` value records a miss which expires
+    after ``negative_ttl`` seconds. Changes are kept in memory until
+    :meth:`flush`. Safe to share between the concurrently syncing sources.
+
+    Attributes:
+        hits (int): Membership tests answered by the cache this cycle
+        misses (int): Membership tests for unknown or expired ids
+    """
+
+    def __init__(
+        self,
+        store: SyncStore,
+        target: str,
+        negative_ttl: int,
+    ) -> None:
+        self._store = store
+        self._target = target
+        self._negative_ttl = negative_ttl
+        self._entries = store.load_matches(target)
+        self._dirty, self._deleted = set(), set()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, entry: Tuple[Optional[str], float]) -> bool:
+        key, checked_at = entry
+        return key is None and time.time() - checked_at > self._negative_ttl
+
+    def __getitem__(self, source_id: str) -> Optional[str]:
+        entry = self._entries[source_id]
+        if self._expired(entry):
+            raise KeyError(source_id)
+        return entry[0]
+
+    def __contains__(self, source_id: object) -> bool:
+        entry = self._entries.get(source_id)
+        found = entry is not None and not self._expired(entry)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def __setitem__(self, source_id: str, key: Optional[str]) -> None:
+        with self._lock:
+            self._entries[source_id] = (key, time.time())
+            self._dirty.add(source_id)
+            self._deleted.discard(source_id)
+
+    def __delitem__(self, source_id: str) -> None:
+        with self._lock:
+            self._entries.pop(source_id, None)
+            self._dirty.discard(source_id)
+            self._deleted.add(source_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def flush(self) -> None:
+        """Persist the changes made since the last flush."""
+        with self._lock:
+            if not (self._dirty or self._deleted):
+                return
+            self._store.save_matches(
+                self._target,
+                [(s, *self._entries[s]) for s in self._dirty],
+                self._deleted,
+            )
+            self._dirty, self._deleted = set(), set()
@@ -0,0 +1,374 @@
+import hashlib
+import logging
+import os
+import sys
+import time
+from itertools import chain
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .helperClasses import Playlist, Track, UserInputs
+from .jellyfin import JellyfinTarget, update_or_create_jellyfin_playlist
+from .metrics import PHASE_SECONDS, PLAYLISTS, TRACKS
+from .missing import export_missing_tracks
+from .pipeline import prefetch
+from .plex import PlexTarget, update_or_create_plex_playlist
+from .store import PlaylistState
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+Target = Union[PlexTarget, JellyfinTarget]
+
+_UPDATES = {
+    PlexTarget: update_or_create_plex_playlist,
+    JellyfinTarget: update_or_create_jellyfin_playlist,
+}
+
+_CLOCK_MARGIN = 3600
+# how long a source waits for a target that is behind before leaving it
+# to fetch the playlist on its own
+_BEHIND_SECONDS = 5
+
+
+def tracks_token(tracks: Iterable[Track]) -> str:
+    """Return a hash of the track ids of a playlist, in order.
+
+    Args:
+        tracks (Iterable[Track]): track objects
+
+    Returns:
+        str: change token for sources without one
+    """
+    digest = hashlib.sha1()
+    for track in tracks:
+        digest.update(
+            (track.url or f"{track.title}|{track.artist}").encode() + b"\n"
+        )
+    return digest.hexdigest()
+
+
+def _is_unchanged(
+    target: Target, playlist: Playlist, token: str, interval: int = 0
+) -> bool:
+    """Check if the target already holds this version of the playlist.
+
+    A playlist synced less than ``interval`` seconds ago is left alone
+    whatever its token. Playlists in which new library items resolved a
+    missing track are marked stale by :func:`recheck_missing_tracks`.
+    """
+    if target.store is None:
+        return False
+    state = target.store.playlist_state(target.name, playlist.id)
+    if state is None or state.name != playlist.name:
+        return False
+    if interval and time.time() - state.synced_at < interval:
+        return True
+    return bool(token) and state.token == token
+
+
+def select_playlists(
+    playlists: List[Playlist], playlist_ids: Optional[Set[str]] = None
+) -> List[Playlist]:
+    """Keep the playlists whose source id is given, all of them for None."""
+    if playlist_ids is None:
+        return playlists
+    return [p for p in playlists if str(p.id) in playlist_ids]
+
+
+def sync_playlist(
+    playlist: Playlist,
+    fetch_tracks: Callable[[Playlist], Iterable[List[Track]]],
+    targets: List[Target],
+    userInputs: UserInputs,
+    source: str = "",
+) -> None:
+    """Fetch a playlist once and update every target holding a stale copy.
+
+    Targets whose recorded change token matches the source, or which
+    synced the playlist within its interval, are skipped.
+    When the source provides no token (``playlist.change_token`` is "") a
+    hash of the fetched track ids is used instead, so only matching and
+    writing are skipped.
+
+    Each page is handed to the ``worker`` of every stale target as it
+    arrives while the source downloads the next ones, the playlist is then
+    written once all its pages are matched. Targets work through their own
+    queue, the call returns once the playlist is fetched. A target only
+    takes a few pages ahead of its matching (``backlog``) so memory stays
+    flat. The source waits a few seconds for a target that is behind, then
+    stops handing it pages and leaves it to fetch the playlist again on its
+    own worker, so a slow server never holds up the others. Pages of
+    sources without a token are held until the hash is known.
+
+    Args:
+        playlist (Playlist): Playlist object
+        fetch_tracks (Callable): Yields the tracks of the playlist in pages
+        targets (List[Target]): servers prepared for the cycle
+        userInputs (UserInputs): user configuration
+        source (str): Name of the source in the metrics
+    """
+    interval = userInputs.playlist_intervals.get(
+        playlist.name, userInputs.playlist_intervals.get(str(playlist.id), 0)
+    )
+
+    def stale(token: str) -> List[Target]:
+        if not userInputs.skip_unchanged_playlists:
+            if not interval:
+                return targets
+            # the playlist interval still holds back a rewrite
+            token = ""
+        fresh = []
+        for target in targets:
+            if _is_unchanged(target, playlist, token, interval):
+                PLAYLISTS.inc(
+                    source=source, target=target.name, result="skipped"
+                )
+            else:
+                fresh.append(target)
+        return fresh
+
+    targets = stale(playlist.change_token)
+    if not targets:
+        logging.info("Playlist %s is unchanged, skipping", playlist.name)
+        return
+
+    fetch_seconds = 0.0
+
+    def waited(pages: Iterable[List[Track]]) -> Iterator[List[Track]]:
+        # time the consumer spends waiting on the source
+        nonlocal fetch_seconds
+        pages = iter(pages)
+        while True:
+            start = time.monotonic()
+            page = next(pages, None)
+            fetch_seconds += time.monotonic() - start
+            if page is None:
+                return
+            yield page
+
+    pages = waited(
+        prefetch(fetch_tracks(playlist), userInputs.fetch_concurrency)
+    )
+    token = playlist.change_token
+    if not token:
+        pages = list(pages)
+        token = tracks_token(chain.from_iterable(pages))
+        targets = stale(token)
+        if not targets:
+            logging.info("Playlist %s is unchanged, skipping", playlist.name)
+            return
+
+    matches = {target: [] for target in targets}
+    behind = []
+    for page in pages:
+        for target in list(matches):
+            if not target.backlog.acquire(timeout=_BEHIND_SECONDS):
+                # the pages it already took are memoized, which makes
+                # fetching them again cheap to match
+                logging.info(
+                    "%s is behind, leaving it to fetch %s on its own",
+                    target.name,
+                    playlist.name,
+                )
+                del matches[target]
+                behind.append(target)
+                continue
+            matches[target].append(
+                target.worker.submit(_match_page, target, page)
+            )
+    PHASE_SECONDS.observe(fetch_seconds, phase="fetch", source=source)
+
+    # queued behind its pages, so a worker never waits on work not started
+    for target, futures in matches.items():
+        target.worker.submit(
+            _write_playlist,
+            target,
+            playlist,
+            (future.result() for future in futures),
+            token,
+            userInputs,
+            source,
+        )
+    for target in behind:
+        target.worker.submit(
+            _write_playlist,
+            target,
+            playlist,
+            _refetched(target, playlist, fetch_tracks),
+            token,
+            userInputs,
+            source,
+        )
+
+
+def _refetched(
+    target: Target,
+    playlist: Playlist,
+    fetch_tracks: Callable[[Playlist], Iterable[List[Track]]],
+) -> Iterator[Tuple[List, List[Track], List[Track], float]]:
+    # one page at a time, the worker fetches and matches in turn
+    for page in fetch_tracks(playlist):
+        yield _timed_match(target, page)
+
+
+def _timed_match(
+    target: Target, page: List[Track]
+) -> Tuple[List, List[Track], List[Track], float]:
+    start = time.monotonic()
+    available, missing, failed = target.match(page)
+    return available, missing, failed, time.monotonic() - start
+
+
+def _match_page(
+    target: Target, page: List[Track]
+) -> Tuple[List, List[Track], List[Track], float]:
+    try:
+        return _timed_match(target, page)
+    finally:
+        target.backlog.release()
+
+
+def _write_playlist(
+    target: Target,
+    playlist: Playlist,
+    pages: Iterable[Tuple[List, List[Track], List[Track], float]],
+    token: str,
+    userInputs: UserInputs,
+    source: str,
+) -> None:
+    """Update a target with the matched pages of a playlist and record it.
+
+    Errors are logged, the playlist is then synced again next cycle. A
+    playlist with tracks whose matching failed is left as it is, writing
+    it would drop those tracks.
+    """
+    try:
+        available, missing, failed, seconds = [], [], [], 0.0
+        for (
+            page_available,
+            page_missing,
+            page_failed,
+            page_seconds,
+        ) in pages:
+            available.extend(page_available)
+            missing.extend(page_missing)
+            failed.extend(page_failed)
+            seconds += page_seconds
+        if failed:
+            raise RuntimeError(f"matching {len(failed)} tracks failed")
+        logging.info(
+            "Matched %s tracks of %s on %s in %.1fs (%.0f tracks/s)",
+            len(available) + len(missing),
+            playlist.name,
+            target.name,
+            seconds,
+            (len(available) + len(missing)) / seconds if seconds else 0,
+        )
+        start = time.monotonic()
+        _UPDATES[type(target)](
+            target, playlist, available, missing, userInputs
+        )
+    except Exception:
+        logging.exception(
+            "Failed to sync playlist %s to %s", playlist.name, target.name
+        )
+        PLAYLISTS.inc(source=source, target=target.name, result="failed")
+        return
+    labels = dict(source=source, target=target.name)
+    PHASE_SECONDS.observe(seconds, phase="match", **labels)
+    PHASE_SECONDS.observe(time.monotonic() - start, phase="write", **labels)
+    PLAYLISTS.inc(result="synced", **labels)
+    TRACKS.inc(len(available), result="found", **labels)
+    TRACKS.inc(len(missing), result="missing", **labels)
+    if target.store is not None:
+        target.store.save_playlist_state(
+            target.name,
+            playlist.id,
+            PlaylistState(
+                name=playlist.name,
+                token=token,
+                generation=target.generation,
+                missing=len(missing),
+            ),
+        )
+        changed = target.store.save_missing_tracks(
+            target.name, playlist.id, missing
+        )
+        if changed and userInputs.write_missing_as_csv:
+            _export_missing(target, playlist, userInputs)
+
+
+def _export_missing(
+    target: Target, playlist: Playlist, userInputs: UserInputs
+) -> None:
+    """Rewrite the missing tracks csv of a playlist after they changed."""
+    try:
+        export_missing_tracks(
+            target.store,
+            os.path.join(userInputs.data_dir, "missing"),
+            target.name,
+            playlist.id,
+        )
+        logging.info("Missing tracks of %s exported", playlist.name)
+    except OSError:
+        logging.info(
+            "Failed to export missing tracks for %s, likely permission"
+            " issue",
+            playlist.name,
+        )
+
+
+def recheck_missing_tracks(target: Target) -> List[str]:
+    """Match missing tracks against the items added since the last check.
+
+    Only the library items added since the previous recheck are listed,
+    tracks they resolve are cached for the target and the playlists holding
+    them are marked stale so the next sync writes just those playlists.
+
+    Args:
+        target (Target): plex or jellyfin server prepared for the cycle
+
+    Returns:
+        List[str]: source ids of the playlists marked stale
+    """
+    stale = []
+    if target.store is None:
+        return stale
+    started = time.time()
+    since = target.store.recheck_time(target.name)
+    missing = target.store.missing_tracks(target.name)
+    if since is not None and missing:
+        # allow for the clocks of this host and the server to differ
+        added = target.recently_added(since - _CLOCK_MARGIN)
+        if added.size:
+            found = {}
+            for playlist_id, tracks in missing.items():
+                for track in tracks:
+                    if track.url not in found:
+                        found[track.url] = added.match(track)
+                if any(found[track.url] for track in tracks):
+                    stale.append(playlist_id)
+            if target.cache is not None:
+                for source_id, key in found.items():
+                    if key is not None:
+                        target.cache[source_id] = key
+                target.cache.flush()
+            target.store.mark_playlists_stale(target.name, stale)
+            logging.info(
+                "%s new items on %s resolved %s missing tracks in %s"
+                " playlists",
+                added.size,
+                target.name,
+                sum(key is not None for key in found.values()),
+                len(stale),
+            )
+    target.store.save_recheck_time(target.name, started)
+    return stale
@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from .helperClasses import UserInputs
+from .matching import LibraryIndex, ResolutionMemo
+from .store import MatchCache, SyncStore
+
+# keys or ids looked up per request, keeps the url short
+IDS_PER_REQUEST = 100
+
+
+class SyncTarget:
+    """A server playlists are synced to, with the state of the current cycle.
+
+    The library index is built on first use by ``_build_index``, so a cycle
+    in which every playlist is unchanged never lists the library.
+
+    Attributes:
+        name (str): Identifies the server in the sync database
+        store (SyncStore): Sync database, None when it is disabled
+        cache (MatchCache): Matches of earlier cycles, None when disabled
+        memo (ResolutionMemo): Matches of this cycle
+        worker (ThreadPoolExecutor): Runs the matching and writing of
+            playlists for this server, shut down by close at the end of
+            the cycle
+        backlog (BoundedSemaphore): Taken for each page handed to the
+            worker until it is matched
+    """
+
+    def __init__(
+        self,
+        name: str,
+        userInputs: UserInputs,
+        store: Optional[SyncStore] = None,
+    ) -> None:
+        self.name = name
+        self.store = store
+        self.cache = None
+        if store is not None and userInputs.match_cache:
+            self.cache = MatchCache(
+                store,
+                self.name,
+                userInputs.match_cache_negative_ttl,
+            )
+        self._index = None
+        self._index_lock = threading.Lock()
+        self.memo = ResolutionMemo()
+        # matches and writes the playlists of every source, so a slow
+        # server only holds up its own playlists
+        self.worker = ThreadPoolExecutor(
+            max_workers=max(userInputs.target_concurrency, 1),
+            thread_name_prefix=self.name,
+        )
+        # pages waiting on the worker, sources stop handing pages to a
+        # server whose slots stay taken, see sync_playlist
+        self.backlog = threading.BoundedSemaphore(
+            2 * max(userInputs.target_concurrency, 1)
+        )
+
+    def _build_index(self) -> Optional[LibraryIndex]:
+        raise NotImplementedError
+
+    @property
+    def index(self) -> Optional[LibraryIndex]:
+        # sources sync concurrently, only the first one builds the index
+        with self._index_lock:
+            if self._index is None:
+                self._index = self._build_index()
+        return self._index
+
+    def _built_index(self) -> Optional[LibraryIndex]:
+        """Return the index if it is built, without building it."""
+        with self._index_lock:
+            return self._index
+
+    def close(self) -> None:
+        """Wait for the queued playlists, then release the worker threads."""
+        self.worker.shutdown()
@@ -0,0 +1,228 @@
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List
+from urllib.parse import urlparse
+from weakref import WeakKeyDictionary
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# server errors and rate limiting, the Retry-After header is honoured
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# methods a read or server error is retried for, writes such as PUT may
+# have been applied before the connection dropped
+_RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# requests already decoded the body these headers describe
+_DECODED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+_counters = WeakKeyDictionary()
+_counters_lock = threading.Lock()
+
+
+@dataclass
+class RequestCount:
+    count: int = 0
+
+
+class RequestCounter:
+    """Counts the HTTP requests sent through a requests session, per host.
+
+    Requests are also counted per thread so a block of code can measure its
+    own requests while other sources use the same session. Responses with
+    an error status are counted in ``errors_by_host`` as well.
+    """
+
+    def __init__(self, session: requests.Session) -> None:
+        self.by_host = Counter()
+        self.errors_by_host = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        session.hooks.setdefault("response", []).append(self._count)
+
+    def _count(self, response: requests.Response, *args, **kwargs) -> None:
+        host = urlparse(response.url).netloc
+        with self._lock:
+            self.by_host[host] += 1
+            if response.status_code >= 400:
+                self.errors_by_host[host] += 1
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.by_host.values())
+
+    @contextmanager
+    def measure(self) -> Iterator["RequestCount"]:
+        """Count the requests the current thread sends inside the block.
+
+        Yields:
+            RequestCount: holds the number of requests once the block exits
+        """
+        result = RequestCount()
+        before = getattr(self._local, "count", 0)
+        try:
+            yield result
+        finally:
+            result.count = getattr(self._local, "count", 0) - before
+
+
+def request_counter(session: requests.Session) -> RequestCounter:
+    """Return the counter of a session, hooking one on first use.
+
+    Sessions live across cycles, so counting through this function never
+    hooks the same session twice.
+
+    Args:
+        session (requests.Session): Session to count the requests of
+
+    Returns:
+        RequestCounter: the counter of the session
+    """
+    with _counters_lock:
+        if session not in _counters:
+            _counters[session] = RequestCounter(session)
+        return _counters[session]
+
+
+def request_counters() -> List[RequestCounter]:
+    """Return the counters of every live session."""
+    with _counters_lock:
+        return list(_counters.values())
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff with full jitter.
+
+    Waits a random time up to the exponential backoff so that concurrent
+    requests failing together do not retry in lockstep.
+    """
+
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, super().get_backoff_time())
+
+
+@dataclass
+class HttpClientInstance:
+    """Session and timeout in the shape the jellyfin client accepts."""
+
+    session: requests.Session
+    timeout: float = 60
+
+
+class SessionTransport(httpx.BaseTransport):
+    """httpx transport sending requests through a requests session.
+
+    Lets httpx based clients such as deezer-python share the pooled
+    connections, retries and request counting of ``new_session``.
+    """
+
+    def __init__(self, session: requests.Session) -> None:
+        self.session = session
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        timeout = request.extensions.get("timeout", {})
+        try:
+            response = self.session.request(
+                request.method,
+                str(request.url),
+                headers=dict(request.headers),
+                data=request.read() or None,
+                timeout=(timeout.get("connect"), timeout.get("read")),
+            )
+        except requests.RequestException as e:
+            raise httpx.TransportError(str(e)) from e
+        return httpx.Response(
+            response.status_code,
+            headers=[
+                (name, value)
+                for name, value in response.headers.items()
+                if name.lower() not in _DECODED_HEADERS
+            ],
+            content=response.content,
+            request=request,
+        )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class RateLimiter:
+    """Spaces out calls shared by several threads to a steady rate."""
+
+    def __init__(self, per_second: float) -> None:
+        self._interval = 1 / per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the caller may send its next request."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Adapter sending requests no faster than its rate limiter allows."""
+
+    def __init__(self, limiter: RateLimiter, **kwargs) -> None:
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.wait()
+        return super().send(request, **kwargs)
+
+
+def new_session(
+    pool_size: int = 10,
+    retries: int = 3,
+    backoff_factor: float = 0.5,
+    requests_per_second: float = 0,
+) -> requests.Session:
+    """Create a session with pooled keep-alive connections and retries.
+
+    Connection errors are retried for every method since the request never
+    reached the server. Read errors and server errors are only retried for
+    GET, HEAD and OPTIONS, a playlist write may already have been applied.
+    After the last attempt the response is returned as is and the client
+    raises its usual error.
+
+    Args:
+        pool_size (int): Connections kept open per host
+        retries (int): Retries after a failed attempt, 0 disables them
+        backoff_factor (float): Base of the exponential backoff in seconds
+        requests_per_second (float): Rate shared by every thread using the
+            session, 0 for no limit
+
+    Returns:
+        requests.Session: session to share between cycles
+    """
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=_RETRY_METHODS,
+        raise_on_status=False,
+    )
+    pool = dict(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    if requests_per_second > 0:
+        adapter = RateLimitedAdapter(RateLimiter(requests_per_second), **pool)
+    else:
+        adapter = HTTPAdapter(**pool)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    request_counter(session)
+    return session
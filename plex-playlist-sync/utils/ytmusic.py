@@ -1,12 +1,15 @@
 import logging
-from typing import List
-
-import spotipy
-from plexapi.server import PlexServer
+from dataclasses import replace
+from typing import List, Tuple
 
 from .helperClasses import Playlist, Track, UserInputs
-from .plex import update_or_create_plex_playlist
-from .jellyfin import update_or_create_jellyfin_playlist
+from .pipeline import map_ahead
+from .sync import select_playlists, sync_playlist
+
+
+def _poster(thumbnails: List[dict]) -> str:
+    # thumbnails are listed from the smallest to the largest
+    return thumbnails[-1].get("url", "") if thumbnails else ""
 
 
 def _get_yt_user_playlists(yt) -> List[Playlist]:
@@ -14,25 +17,37 @@ def _get_yt_user_playlists(yt) -> List[Playlist]:
     playlists = []
 
     try:
-        yt_playlists = yt.get_library_playlists()
+        yt_playlists = yt.get_library_playlists(limit=None)
         for playlist in yt_playlists:
             playlists.append(
                 Playlist(
                     id=playlist["playlistId"],
                     name=playlist["title"],
-                    description=playlist.get("description", ""),
+                    description=playlist.get("description") or "",
                     # playlists may not have a poster in such cases return ""
-                    poster=""
-                    # if len(playlist["images"]) == 0
-                    # else playlist["images"][0].get("url", ""),
+                    poster=_poster(playlist.get("thumbnails")),
                 )
             )
     except:
-        logging.error("Spotify User ID Error")
+        logging.error("YouTube Music library Error")
     return playlists
 
 
-def _get_yt_tracks_from_playlist(yt, playlist: Playlist) -> List[Track]:
+def _get_yt_tracks_from_playlist(
+    yt, playlist: Playlist
+) -> Tuple[Playlist, List[Track]]:
+    """Return the tracks of a playlist and the playlist with its metadata.
+
+    The description and poster come with the tracks, the returned playlist
+    holds them so no other request is needed.
+
+    Args:
+        yt (YTMusic): YTMusic configured instance
+        playlist (Playlist): Playlist object
+
+    Returns:
+        Tuple[Playlist, List[Track]]: playlist and its Track objects
+    """
 
     def extract_sp_track_metadata(track) -> Track:
         title = track["title"]
@@ -42,7 +57,14 @@ def _get_yt_tracks_from_playlist(yt, playlist: Playlist) -> List[Track]:
         else:
             album = ""
         url = "https://music.youtube.com/watch?v="+track['videoId']
-        return Track(title, artist, album, url)
+        return Track(
+            title,
+            artist,
+            album,
+            url,
+            duration=(track.get("duration_seconds") or 0) * 1000,
+            provider_ids={"youtube": track["videoId"]},
+        )
 
     # return all tracks in a playlist
     yt_playlist_tracks = yt.get_playlist(playlist.id, None)
@@ -53,17 +75,37 @@ def _get_yt_tracks_from_playlist(yt, playlist: Playlist) -> List[Track]:
             [i for i in yt_playlist_tracks['tracks'] if i.get("title")],
         )
     )
-    return tracks
+    playlist = replace(
+        playlist,
+        description=yt_playlist_tracks.get("description")
+        or playlist.description,
+        poster=_poster(yt_playlist_tracks.get("thumbnails"))
+        or playlist.poster,
+    )
+    return playlist, tracks
 
 
-def ytmusic_playlist_sync(yt, plex, jellyfin, userInputs) -> None:
+def ytmusic_playlist_sync(
+    yt, targets, userInputs: UserInputs, playlist_ids=None
+) -> None:
     playlists = _get_yt_user_playlists(yt)
     if playlists:
-        for playlist in playlists:
-            tracks = _get_yt_tracks_from_playlist(yt, playlist)
-            if plex is not None:
-                update_or_create_plex_playlist(plex, playlist, tracks, userInputs)
-            if jellyfin is not None:
-                update_or_create_jellyfin_playlist(jellyfin, playlist, tracks, userInputs)
+        playlists = select_playlists(playlists, playlist_ids)
+        # ytmusic has no playlist version, every playlist is fetched to hash
+        # its tracks, the next ones download while one is being synced
+        fetched = map_ahead(
+            lambda p: _get_yt_tracks_from_playlist(yt, p),
+            playlists,
+            userInputs.ytmusic_concurrency,
+        )
+        for playlist, tracks in fetched:
+            sync_playlist(
+                playlist,
+                # the whole playlist comes back in one response
+                lambda p, tracks=tracks: [tracks],
+                targets,
+                userInputs,
+                "ytmusic",
+            )
     else:
-        logging.error("No spotify playlists found for given user")
+        logging.error("No youtube music playlists found for given user")